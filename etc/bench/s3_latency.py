@@ -0,0 +1,95 @@
+"""
+Per-call latency of `quirck.core.s3` helpers with a shared client versus a client
+created for every call (the behaviour before the shared client was introduced).
+Caches of presigned URLs and listings are cleared before every "shared" call, so
+that those rows measure the client; "cached" rows show the cache hits.
+
+Start MinIO with `docker compose up -d s3`, create the bucket and run from the
+repository root with the usual `.env`:
+
+    uv run python etc/bench/s3_latency.py [--calls 200]
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from quirck.core import s3
+
+
+async def measure(name: str, calls: int, func) -> None:
+    samples = []
+    for _ in range(calls):
+        started_at = time.perf_counter()
+        await func()
+        samples.append((time.perf_counter() - started_at) * 1000)
+
+    samples.sort()
+    print(
+        f"{name:<28} p50={statistics.median(samples):7.2f} ms"
+        f"  p99={samples[int(len(samples) * 0.99) - 1]:7.2f} ms"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=200)
+    args = parser.parse_args()
+
+    bucket = s3.S3_DEFAULT_BUCKET
+    payload = b"x" * 1024
+
+    async def per_call(operation):
+        # The behaviour before the shared client: new session and client each call
+        async with s3.get_client() as client:
+            return await operation(client)
+
+    def presign(client):
+        return client.generate_presigned_url(
+            ClientMethod="get_object",
+            Params={"Bucket": bucket, "Key": "bench/0/file"},
+            ExpiresIn=3600,
+        )
+
+    def put(client):
+        return client.put_object(Bucket=bucket, Key="bench/0/file", Body=payload)
+
+    def list_prefix(client):
+        return client.list_objects_v2(Bucket=bucket, Prefix="bench/0/")
+
+    async def uncached(operation):
+        s3.url_cache.clear()
+        s3.list_cache.clear()
+        return await operation
+
+    await measure("get_url, client per call", args.calls, lambda: per_call(presign))
+    await measure(
+        "get_url, shared",
+        args.calls,
+        lambda: uncached(s3.get_url(bucket, "bench", 0, "file")),
+    )
+    await measure(
+        "get_url, cached",
+        args.calls,
+        lambda: s3.get_url(bucket, "bench", 0, "file"),
+    )
+    await measure("upload, client per call", args.calls, lambda: per_call(put))
+    await measure(
+        "upload, shared",
+        args.calls,
+        lambda: s3.upload_bytes(bucket, "bench", 0, "file", payload),
+    )
+    await measure("list, client per call", args.calls, lambda: per_call(list_prefix))
+    await measure(
+        "list, shared",
+        args.calls,
+        lambda: uncached(s3.list_files(bucket, "bench", 0)),
+    )
+    await measure("list, cached", args.calls, lambda: s3.list_files(bucket, "bench", 0))
+
+    await s3.close_shared_client()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
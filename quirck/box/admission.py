@@ -0,0 +1,230 @@
+"""
+Admission control of launches.
+
+Every launch takes a ticket in `docker_admission`. A ticket is admitted when it is
+the oldest queued one and there is capacity left: fewer than
+`ADMISSION_CONCURRENCY` launches are in progress, and memory limits of running
+deployments plus the new one fit into `ADMISSION_MEMORY_MB`. The decision is
+taken under an advisory lock, so that it is shared by all workers and hosts.
+
+Admitted tickets are kept while the deployment runs and removed when it stops.
+Deployments of warm pools have no tickets, their memory is reserved by pool slots
+instead, see `used_memory`. Tickets of deployments claimed from a pool keep only
+the memory of containers created on top of it.
+Launches that are not admitted in `ADMISSION_WAIT` seconds fail with
+`LaunchQueued`, which carries the position in the queue; the ticket keeps its
+place as long as the user retries within `ADMISSION_QUEUE_TTL` seconds.
+"""
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable
+
+from sqlalchemy import case, delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from quirck.box.config import (
+    ADMISSION_CONCURRENCY,
+    ADMISSION_MEMORY_MB,
+    ADMISSION_QUEUE_TTL,
+    ADMISSION_WAIT,
+)
+from quirck.box.exception import LaunchQueued
+from quirck.box.meta import Deployment
+from quirck.box.model import AdmissionState, DockerAdmission, DockerPoolSlot
+
+logger = logging.getLogger(__name__)
+
+# Launches in progress for longer than that are not counted towards concurrency
+STALE_LAUNCH_AGE = timedelta(minutes=15)
+
+POLL_INTERVAL = 1
+
+
+def deployment_memory(deployment: Deployment) -> int:
+    return sum(container.mem_limit for container in deployment.containers)
+
+
+async def used_memory(session: AsyncSession) -> int:
+    """Returns memory reserved by admitted launches and warm pool slots."""
+    admitted = await session.scalar(
+        select(func.coalesce(func.sum(DockerAdmission.memory), 0)).where(
+            DockerAdmission.state != AdmissionState.QUEUED
+        )
+    )
+    pooled = await session.scalar(
+        select(func.coalesce(func.sum(DockerPoolSlot.memory), 0))
+    )
+    return int(admitted) + int(pooled)
+
+
+async def enqueue(session: AsyncSession, user_id: int, memory: int) -> None:
+    """Creates a ticket or refreshes the existing one, keeping its place in queue."""
+    now = datetime.now(timezone.utc)
+    table = DockerAdmission.__table__
+
+    statement = insert(DockerAdmission).values(
+        user_id=user_id,
+        state=AdmissionState.QUEUED,
+        memory=memory,
+        queued_at=now,
+        touched_at=now,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id"],
+        set_={
+            "state": AdmissionState.QUEUED,
+            "memory": memory,
+            "touched_at": now,
+            "queued_at": case(
+                (
+                    (table.c.state == AdmissionState.QUEUED)
+                    & (
+                        table.c.touched_at
+                        >= now - timedelta(seconds=ADMISSION_QUEUE_TTL)
+                    ),
+                    table.c.queued_at,
+                ),
+                else_=now,
+            ),
+            "admitted_at": None,
+        },
+    )
+
+    await session.execute(statement)
+    await session.commit()
+
+
+async def try_admit(session: AsyncSession, user_id: int) -> int:
+    """Returns 0 if the ticket is admitted, otherwise its position in queue."""
+    now = datetime.now(timezone.utc)
+
+    await session.execute(
+        select(func.pg_advisory_xact_lock(func.hashtext("admission")))
+    )
+
+    # Drop tickets of users who gave up waiting
+    await session.execute(
+        delete(DockerAdmission).where(
+            DockerAdmission.state == AdmissionState.QUEUED,
+            DockerAdmission.touched_at < now - timedelta(seconds=ADMISSION_QUEUE_TTL),
+            DockerAdmission.user_id != user_id,
+        )
+    )
+
+    ticket = await session.get(DockerAdmission, user_id, populate_existing=True)
+    if ticket is None or ticket.state != AdmissionState.QUEUED:
+        await session.commit()
+        return 0
+
+    ahead = await session.scalar(
+        select(func.count()).where(
+            DockerAdmission.state == AdmissionState.QUEUED,
+            (DockerAdmission.queued_at < ticket.queued_at)
+            | (
+                (DockerAdmission.queued_at == ticket.queued_at)
+                & (DockerAdmission.user_id < ticket.user_id)
+            ),
+        )
+    )
+
+    launching = await session.scalar(
+        select(func.count()).where(
+            DockerAdmission.state == AdmissionState.LAUNCHING,
+            DockerAdmission.admitted_at >= now - STALE_LAUNCH_AGE,
+        )
+    )
+    used = await used_memory(session)
+
+    fits = (
+        ADMISSION_MEMORY_MB <= 0
+        # A deployment larger than the whole capacity is launched alone
+        or used == 0
+        or used + ticket.memory <= ADMISSION_MEMORY_MB * 1024 * 1024
+    )
+
+    if ahead or launching >= ADMISSION_CONCURRENCY or not fits:
+        await session.commit()
+        return (ahead or 0) + 1
+
+    ticket.state = AdmissionState.LAUNCHING
+    ticket.admitted_at = now
+    await session.commit()
+
+    return 0
+
+
+async def admit(
+    session: AsyncSession,
+    user_id: int,
+    memory: int,
+    wait: float = ADMISSION_WAIT,
+    on_queued: Callable[[int], Awaitable[None]] | None = None,
+) -> None:
+    """Waits until the launch is admitted, calling `on_queued` with the position
+    while queued. Raises `LaunchQueued` after `wait` seconds."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + wait
+
+    while True:
+        await enqueue(session, user_id, memory)
+
+        position = await try_admit(session, user_id)
+        if not position:
+            return
+
+        if loop.time() >= deadline:
+            logger.info("Launch of user %d is queued at #%d", user_id, position)
+            raise LaunchQueued(position)
+
+        if on_queued is not None:
+            await on_queued(position)
+
+        await asyncio.sleep(POLL_INTERVAL)
+
+
+async def is_running(session: AsyncSession, user_id: int) -> bool:
+    """Returns whether the user's deployment still holds its capacity, e.g. when
+    it is paused without reclaiming memory."""
+    state = await session.scalar(
+        select(DockerAdmission.state).where(DockerAdmission.user_id == user_id)
+    )
+    return state == AdmissionState.RUNNING
+
+
+async def hand_over(session: AsyncSession, user_id: int, memory: int) -> None:
+    """Removes `memory` of a claimed pool slot from the user's ticket, as the slot
+    keeps reserving it."""
+    await session.execute(
+        update(DockerAdmission)
+        .where(DockerAdmission.user_id == user_id)
+        .values(memory=func.greatest(DockerAdmission.memory - memory, 0))
+    )
+
+
+async def mark_running(session: AsyncSession, user_id: int) -> None:
+    await session.execute(
+        update(DockerAdmission)
+        .where(DockerAdmission.user_id == user_id)
+        .values(state=AdmissionState.RUNNING)
+    )
+
+
+async def release(session: AsyncSession, user_id: int) -> None:
+    """Frees capacity taken by the user's deployment."""
+    await session.execute(
+        delete(DockerAdmission).where(DockerAdmission.user_id == user_id)
+    )
+
+
+__all__ = [
+    "admit",
+    "deployment_memory",
+    "hand_over",
+    "is_running",
+    "mark_running",
+    "release",
+    "used_memory",
+]
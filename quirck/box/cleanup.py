@@ -2,12 +2,15 @@
 """
 Utility script to cleanup inactive lab instances.
 
-This script can be run as a cron job or scheduled task to automatically
-stop instances based on various criteria:
+This script can be run as a cron job or scheduled task, or as a daemon with
+`--daemon`, to automatically stop instances based on various criteria:
 - Maximum runtime
 - Inactivity (no recent VPN connections)
 - Low traffic throughput
 
+With `--pause`, idle instances are paused instead and stopped only after staying
+paused for a while, so that students coming back resume them quickly.
+
 Usage:
     python -m quirck.box.cleanup [OPTIONS]
 
@@ -21,22 +24,37 @@ Examples:
     # Stop instances inactive for 60+ minutes (if also older than 90 min)
     python -m quirck.box.cleanup --inactive-for 90 --disconnected 60 --low-traffic 60
 
+    # Pause idle instances, stop those paused for 12+ hours
+    python -m quirck.box.cleanup --pause --paused-for 720
+
+    # Run permanently, collecting statistics every minute and reaping every 5
+    python -m quirck.box.cleanup --daemon --stats-interval 60 --reap-interval 300
+
 """
 
 import argparse
 import asyncio
+import functools
 import logging
+from typing import Awaitable, Callable
 
-from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
 
+from quirck.box.client import close_docker
+from quirck.box.config import STOP_CONCURRENCY
 from quirck.box.docker import (
     cleanup_client_stats,
     find_active_dockers,
     find_instances_to_reap,
-    stop,
-    update_client_stats,
+    get_full_object_name,
+    pause,
+    stop_many,
+    update_all_client_stats,
 )
-from quirck.box.exception import DockerConflict
+from quirck.box.model import DockerState
+from quirck.box.openvpn import ManagementCollector
+from quirck.box.stats import ChangeRecorder
 from quirck.db.engine import get_engine
 from quirck.core.config import DATABASE_URL
 
@@ -44,6 +62,12 @@ logging.basicConfig(level=logging.INFO, format="%(name)s - %(levelname)s - %(mes
 
 logger = logging.getLogger(__name__)
 
+LOCK_NAME = "cleanup"
+
+# Activity criteria are evaluated only if statistics have been collected within
+# this many statistics intervals, otherwise every instance would look inactive
+STATS_MAX_AGE_INTERVALS = 3
+
 
 async def main():
     parser = argparse.ArgumentParser(
@@ -73,6 +97,63 @@ async def main():
         default=60,
         help="Minutes of low traffic (<1KB/min) to mark as inactive (default: 60, set to 0 to disable)",
     )
+    parser.add_argument(
+        "--pause",
+        action="store_true",
+        help="Pause inactive instances instead of stopping them",
+    )
+    parser.add_argument(
+        "--reclaim-memory",
+        action="store_true",
+        help="Stop containers of paused instances without removal to free memory",
+    )
+    parser.add_argument(
+        "--paused-for",
+        type=int,
+        default=24 * 60,
+        help="Minutes after which paused instances are stopped (default: 1440 = 24h, set to 0 to disable)",
+    )
+    parser.add_argument(
+        "--failed-for",
+        type=int,
+        default=30,
+        help="Minutes after which failed instances are stopped (default: 30, set to 0 to stop them on the next pass)",
+    )
+    parser.add_argument(
+        "--stats-concurrency",
+        type=int,
+        default=16,
+        help="Number of VPN containers queried for statistics at once (default: 16)",
+    )
+    parser.add_argument(
+        "--stats-timeout",
+        type=float,
+        default=10,
+        help="Seconds to wait for statistics of a single container (default: 10)",
+    )
+    parser.add_argument(
+        "--stop-concurrency",
+        type=int,
+        default=STOP_CONCURRENCY,
+        help=f"Number of instances stopped at once (default: {STOP_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running, collecting statistics and reaping on their own schedules",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=int,
+        default=60,
+        help="Seconds between statistics passes in daemon mode (default: 60)",
+    )
+    parser.add_argument(
+        "--reap-interval",
+        type=int,
+        default=300,
+        help="Seconds between reaping passes in daemon mode (default: 300)",
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
@@ -85,81 +166,200 @@ async def main():
     max_runtime = args.max_runtime if args.max_runtime > 0 else None
     disconnected = args.disconnected if args.disconnected > 0 else None
     low_traffic = args.low_traffic if args.low_traffic > 0 else None
+    paused_for = args.paused_for if args.paused_for > 0 else None
 
     logger.info(
-        "Starting cleanup: max_runtime=%s min, inactive_for=%s min, disconnected=%s min, low_traffic=%s min, dry_run=%s",
+        "Starting cleanup: max_runtime=%s min, inactive_for=%s min, disconnected=%s min, low_traffic=%s min, pause=%s, paused_for=%s min, dry_run=%s",
         max_runtime or "disabled",
         args.inactive_for,
         disconnected or "disabled",
         low_traffic or "disabled",
+        args.pause,
+        paused_for or "disabled",
         args.dry_run,
     )
 
     # Create database session factory
     engine = get_engine(DATABASE_URL)
     session_factory = async_sessionmaker(engine, expire_on_commit=False)
+    collector = ManagementCollector(timeout=args.stats_timeout)
+    # Skipped samples are only kept in memory, which a single pass would lose
+    recorder = ChangeRecorder() if args.daemon else None
 
-    try:
-        async with session_factory() as session:
-            ready_containers = await find_active_dockers(session)
-            for docker in ready_containers:
-                await update_client_stats(session, docker)
-            await cleanup_client_stats(session)
-
-            # Find instances to reap
-            user_ids_to_reap = await find_instances_to_reap(
-                session,
-                reap_older_than_minutes=max_runtime,
-                reap_disconnected_for_minutes=disconnected,
-                reap_low_traffic_for_minutes=low_traffic,
-                reap_inactive_if_older=args.inactive_for,
-            )
+    loop = asyncio.get_running_loop()
+    stats_collected_at: float | None = None
 
-            if not user_ids_to_reap:
-                logger.info("No instances found to reap")
-                return
+    async def stats_pass() -> None:
+        nonlocal stats_collected_at
+        await collect_stats(session_factory, collector, recorder, args)
+        stats_collected_at = loop.time()
 
-            logger.info(
-                "Found %d instances to reap: %s",
-                len(user_ids_to_reap),
-                user_ids_to_reap,
+    async def reap_pass() -> None:
+        stats_fresh = (
+            stats_collected_at is not None
+            and loop.time() - stats_collected_at
+            <= STATS_MAX_AGE_INTERVALS * args.stats_interval
+        )
+        if not stats_fresh:
+            logger.warning(
+                "No statistics collected recently, not reaping inactive instances"
             )
 
-            if args.dry_run:
-                logger.info("Dry run mode - not stopping instances")
-                return
+        await reap(
+            session_factory,
+            args,
+            max_runtime=max_runtime,
+            disconnected=disconnected if stats_fresh else None,
+            low_traffic=low_traffic if stats_fresh else None,
+            paused_for=paused_for,
+        )
+
+    try:
+        if args.daemon:
+            await run_daemon(engine, args, stats_pass, reap_pass)
+        else:
+            await stats_pass()
+            await reap_pass()
+    finally:
+        await collector.close()
+        await close_docker()
+        await engine.dispose()
+
+
+async def collect_stats(
+    session_factory: async_sessionmaker[AsyncSession],
+    collector: ManagementCollector,
+    recorder: ChangeRecorder | None,
+    args: argparse.Namespace,
+) -> None:
+    async with session_factory() as session:
+        ready_containers = await find_active_dockers(session)
+        await update_all_client_stats(
+            session,
+            ready_containers,
+            concurrency=args.stats_concurrency,
+            timeout=args.stats_timeout,
+            collector=collector,
+            recorder=recorder,
+        )
+        await cleanup_client_stats(session)
+
+    # Drop connections to relays of stopped instances
+    await collector.forget(
+        {get_full_object_name(docker.user_id, "vpn") for docker in ready_containers}
+    )
+
+
+async def reap(
+    session_factory: async_sessionmaker[AsyncSession],
+    args: argparse.Namespace,
+    max_runtime: int | None,
+    disconnected: int | None,
+    low_traffic: int | None,
+    paused_for: int | None,
+) -> None:
+    async with session_factory() as session:
+        # Find instances to reap
+        candidates = await find_instances_to_reap(
+            session,
+            reap_older_than_minutes=max_runtime,
+            reap_disconnected_for_minutes=disconnected,
+            reap_low_traffic_for_minutes=low_traffic,
+            reap_inactive_if_older=args.inactive_for,
+            reap_paused_for_minutes=paused_for,
+            reap_failed_for_minutes=args.failed_for,
+        )
 
-            # Stop instances
-            stopped_count = 0
-            failed_count = 0
+    if not candidates:
+        logger.info("No instances found to reap")
+        return
+
+    # Failed and long paused instances are always stopped
+    user_ids_to_pause = [
+        candidate.user_id
+        for candidate in candidates
+        if args.pause and candidate.state == DockerState.READY
+    ]
+    user_ids_to_reap = [
+        candidate.user_id
+        for candidate in candidates
+        if candidate.user_id not in user_ids_to_pause
+    ]
+    logger.info(
+        "Found %d instances to pause: %s, %d instances to reap: %s",
+        len(user_ids_to_pause),
+        user_ids_to_pause,
+        len(user_ids_to_reap),
+        user_ids_to_reap,
+    )
+
+    if args.dry_run:
+        logger.info("Dry run mode - not stopping instances")
+        return
+
+    if user_ids_to_pause:
+        summary = await stop_many(
+            session_factory,
+            user_ids_to_pause,
+            concurrency=args.stop_concurrency,
+            action=functools.partial(pause, reclaim_memory=args.reclaim_memory),
+        )
+        logger.info("Pausing complete: %s", summary)
+
+    if user_ids_to_reap:
+        summary = await stop_many(
+            session_factory, user_ids_to_reap, concurrency=args.stop_concurrency
+        )
+        logger.info("Cleanup complete: %s", summary)
+
+
+async def run_daemon(
+    engine: AsyncEngine,
+    args: argparse.Namespace,
+    stats_pass: Callable[[], Awaitable[None]],
+    reap_pass: Callable[[], Awaitable[None]],
+) -> None:
+    """
+    Runs passes on their own schedules while holding an advisory lock, so that only
+    one daemon is active across hosts. Others wait until the lock is released.
+    The lock belongs to a dedicated connection: if it is lost, the daemon exits.
+    """
+    async with engine.connect() as lock_connection:
+        while not await lock_connection.scalar(
+            select(func.pg_try_advisory_lock(func.hashtext(LOCK_NAME)))
+        ):
+            await lock_connection.commit()
+            logger.info("Another cleanup daemon is active, waiting")
+            await asyncio.sleep(args.stats_interval)
+
+        await lock_connection.commit()
+        logger.info("Cleanup daemon is active")
+
+        loop = asyncio.get_running_loop()
+        schedule = {
+            stats_pass: (args.stats_interval, loop.time()),
+            reap_pass: (args.reap_interval, loop.time()),
+        }
+
+        while True:
+            for run_pass, (interval, next_run) in schedule.items():
+                if loop.time() < next_run:
+                    continue
 
-            for user_id in user_ids_to_reap:
                 try:
-                    # Create new session for each stop operation
-                    async with session_factory() as stop_session:
-                        await stop(stop_session, user_id)
-                        stopped_count += 1
-                        logger.info(
-                            "Successfully stopped instance for user %d", user_id
-                        )
-                except DockerConflict:
-                    logger.warning(
-                        "Could not stop user %d: container state conflict", user_id
-                    )
-                    failed_count += 1
-                except Exception as e:
-                    logger.error(
-                        "Error stopping user %d: %s", user_id, e, exc_info=True
-                    )
-                    failed_count += 1
-
-            logger.info(
-                "Cleanup complete: stopped %d instances, failed %d",
-                stopped_count,
-                failed_count,
+                    await run_pass()
+                except Exception:
+                    logger.exception("Cleanup pass failed")
+
+                schedule[run_pass] = (interval, loop.time() + interval)
+
+            await asyncio.sleep(
+                max(min(at for _, at in schedule.values()) - loop.time(), 0)
             )
-    finally:
-        await engine.dispose()
+
+            # Fails if the connection holding the lock is gone
+            await lock_connection.scalar(select(1))
+            await lock_connection.commit()
 
 
 if __name__ == "__main__":
@@ -1,3 +1,43 @@
 from quirck.core.config import config
 
 VPN_HOST = config("VPN_HOST", cast=str)
+
+DOCKER_HOST = config("DOCKER_HOST", cast=str, default="unix:///var/run/docker.sock")
+DOCKER_POOL_SIZE = config("DOCKER_POOL_SIZE", cast=int, default=32)
+# Multiple Docker hosts, see `quirck.box.client`
+DOCKER_NODES = config("DOCKER_NODES", cast=str, default="")
+# Directory with ca.pem, cert.pem and key.pem for TLS connections to TCP nodes
+DOCKER_CERT_PATH = config("DOCKER_CERT_PATH", cast=str, default="")
+
+LAUNCH_CONCURRENCY = config("LAUNCH_CONCURRENCY", cast=int, default=8)
+# Launch admission: deployments being launched at once across all workers, and total
+# memory limit of running deployments in MiB (0 means unlimited)
+ADMISSION_CONCURRENCY = config("ADMISSION_CONCURRENCY", cast=int, default=8)
+ADMISSION_MEMORY_MB = config("ADMISSION_MEMORY_MB", cast=int, default=0)
+# Seconds a launch request waits in the queue before the position is reported
+ADMISSION_WAIT = config("ADMISSION_WAIT", cast=float, default=20)
+# Seconds a queued ticket is kept without the user asking for it
+ADMISSION_QUEUE_TTL = config("ADMISSION_QUEUE_TTL", cast=float, default=60)
+# Number of instances stopped at once by bulk stops and the reaper
+STOP_CONCURRENCY = config("STOP_CONCURRENCY", cast=int, default=16)
+
+WARM_POOL_SIZE = config("WARM_POOL_SIZE", cast=int, default=4)
+# Images pulled at once by `quirck.box.images`, across all nodes
+IMAGE_PULL_CONCURRENCY = config("IMAGE_PULL_CONCURRENCY", cast=int, default=4)
+
+# Where VPN keys are generated: "thread" or "process" pool
+VPN_CRYPTO_EXECUTOR = config("VPN_CRYPTO_EXECUTOR", cast=str, default="thread")
+VPN_CRYPTO_WORKERS = config("VPN_CRYPTO_WORKERS", cast=int, default=2)
+# Maximum number of generations submitted to the pool at once, others wait
+VPN_CRYPTO_QUEUE = config("VPN_CRYPTO_QUEUE", cast=int, default=16)
+
+VPN_STOCK_SIZE = config("VPN_STOCK_SIZE", cast=int, default=100)
+VPN_CONFIG_CACHE_SIZE = config("VPN_CONFIG_CACHE_SIZE", cast=int, default=1024)
+
+# Raw VPN client samples are kept in daily partitions, hourly rollups live longer
+CLIENT_STATS_RETENTION_DAYS = config("CLIENT_STATS_RETENTION_DAYS", cast=int, default=7)
+CLIENT_STATS_ROLLUP_RETENTION_DAYS = config(
+    "CLIENT_STATS_ROLLUP_RETENTION_DAYS", cast=int, default=90
+)
+# Samples with unchanged counters are stored at most once per this many seconds
+CLIENT_STATS_HEARTBEAT = config("CLIENT_STATS_HEARTBEAT", cast=int, default=15 * 60)
@@ -1,41 +1,119 @@
+import asyncio
+import hashlib
+import json
 import logging
+from dataclasses import asdict
 from datetime import datetime, timezone, timedelta
-from typing import Any, Sequence
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Protocol, Sequence
 
-import aiodocker
 from aiodocker.containers import DockerContainer
+from aiodocker.exceptions import DockerError
 from aiodocker.execs import Exec
 from aiodocker.networks import DockerNetwork
-from attr import dataclass
-from sqlalchemy import delete, select
-from sqlalchemy.ext.asyncio import AsyncSession
-
-from quirck.box.exception import DockerConflict
+from attr import Factory, dataclass
+from sqlalchemy import and_, false, func, insert, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.client import get_docker, get_node
+from quirck.box.config import ADMISSION_WAIT, LAUNCH_CONCURRENCY, STOP_CONCURRENCY
+from quirck.box.admission import (
+    admit,
+    deployment_memory,
+    is_running,
+    mark_running,
+    release,
+)
+from quirck.box.exception import DockerConflict, LaunchQueued
+from quirck.box.images import pin_images, pull
 from quirck.box.meta import ContainerMeta, ContainerNetworkMeta, Deployment, NetworkMeta
-from quirck.box.model import DockerClientStats, DockerMeta, DockerState
-from quirck.box.vpn import generate_vpn
+from quirck.box.model import (
+    DockerClientStats,
+    DockerClientStatsHourly,
+    DockerMeta,
+    DockerPoolSlot,
+    DockerState,
+)
+from quirck.box.openvpn import ManagementCollector, ManagementError
+from quirck.box.placement import choose_node
+from quirck.box.stats import (
+    ChangeRecorder,
+    ClientStatPoint,
+    delete_expired_rollups,
+    drop_expired_partitions,
+    ensure_partitions,
+    rollup_client_stats,
+)
+from quirck.box.tasks import bounded, gather_cancelling
+from quirck.box.timing import declare_images, measure, measured, timed
+from quirck.box.vpn import generate_vpn, get_vpn_environment
 from quirck.core import config
 
+if TYPE_CHECKING:
+    from quirck.box.pool import WarmPool
+
 logger = logging.getLogger(__name__)
 
 
-def get_full_object_name(user_id: int, name: str) -> str:
+def get_full_object_name(user_id: int | str, name: str) -> str:
     return f"quirck-{config.APP_MODULE}-{user_id}-{name}"
 
 
-async def create_network(user_id: int, network: NetworkMeta) -> DockerNetwork:
-    async with aiodocker.Docker() as client:
-        return await client.networks.create(
-            {
-                "Name": get_full_object_name(user_id, network.name),
-                "Driver": "kathara/katharanp:amd64",
-                "IPAM": {"Driver": "null"},
-                "Labels": {"user_id": f"{user_id}"},
-                "CheckDuplicate": True,
-                "EnableIPv6": True,
-            }
+@dataclass(frozen=True)
+class Owner:
+    """Names, labels and common environment of Docker objects of one deployment."""
+
+    name: str
+    labels: dict[str, str | None]
+    environment: dict[str, Any]
+    # Docker node the objects live on
+    node: str | None = None
+
+    @staticmethod
+    def user(meta: DockerMeta) -> "Owner":
+        return Owner(
+            name=f"{meta.user_id}",
+            labels={"user_id": f"{meta.user_id}", "chapter": meta.chapter},
+            environment={"USER_ID": meta.user_id},
+            node=meta.node,
+        )
+
+    @staticmethod
+    def pool_slot(slot: DockerPoolSlot) -> "Owner":
+        return Owner(
+            name=f"pool{slot.id}",
+            labels={"pool_slot": f"{slot.id}", "chapter": slot.chapter},
+            environment={},
+            node=slot.node,
         )
 
+    def object_name(self, name: str) -> str:
+        return get_full_object_name(self.name, name)
+
+
+def config_hash(config: Any) -> str:
+    """Digest of a Docker object configuration, stored in `config_hash` label to
+    find objects that have to be recreated, see `reconcile`."""
+    encoded = json.dumps(config, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def network_config(owner: Owner, network: NetworkMeta) -> dict[str, Any]:
+    config: dict[str, Any] = {
+        "Name": owner.object_name(network.name),
+        "Driver": "kathara/katharanp:amd64",
+        "IPAM": {"Driver": "null"},
+        "Labels": owner.labels,
+        "CheckDuplicate": True,
+        "EnableIPv6": True,
+    }
+    config["Labels"] = {**owner.labels, "config_hash": config_hash(config)}
+
+    return config
+
+
+async def create_network(owner: Owner, network: NetworkMeta) -> DockerNetwork:
+    return await get_docker(owner.node).networks.create(network_config(owner, network))
+
 
 def kathara_endpoint_config(network: ContainerNetworkMeta) -> dict[str, Any]:
     sysctls = ",".join(["net.ipv6.conf.IFNAME.disable_ipv6=0"] + network.sysctls)
@@ -52,18 +130,27 @@ def kathara_endpoint_config(network: ContainerNetworkMeta) -> dict[str, Any]:
     return config
 
 
-async def run_container(meta: DockerMeta, container: ContainerMeta) -> DockerContainer:
-    environment: dict[str, Any] = {"USER_ID": meta.user_id}
+def container_config(
+    container: ContainerMeta,
+    owner: Owner,
+    meta: DockerMeta | None = None,
+    network_owner: Owner | None = None,
+) -> tuple[dict[str, Any], list[ContainerNetworkMeta]]:
+    """Returns configuration of a container attached to its first network (or to
+    the host bridge), and the networks it has to be connected to afterwards."""
+    network_owner = network_owner or owner
+
+    environment: dict[str, Any] = dict(owner.environment)
     environment.update(container.environment)
 
     options: dict[str, Any] = {}
     host_options: dict[str, Any] = {}
 
     if container.vpn:
-        if meta.vpn is None:
+        if meta is None or meta.vpn is None:
             raise ValueError("No VPN configuration available")
 
-        environment.update(meta.vpn)
+        environment.update(get_vpn_environment(meta.vpn))
 
         host_options["PortBindings"] = {"1194/tcp": [{"HostPort": str(meta.port)}]}
 
@@ -88,13 +175,11 @@ async def run_container(meta: DockerMeta, container: ContainerMeta) -> DockerCon
         # Otherwise, we choose any of required networks
         first_net, *networks = container.networks
 
-        host_options["NetworkMode"] = get_full_object_name(
-            meta.user_id, first_net.network_name
-        )
+        host_options["NetworkMode"] = network_owner.object_name(first_net.network_name)
         options["NetworkingConfig"] = {
             "EndpointsConfig": {
-                get_full_object_name(
-                    meta.user_id, first_net.network_name
+                network_owner.object_name(
+                    first_net.network_name
                 ): kathara_endpoint_config(first_net)
             }
         }
@@ -104,46 +189,166 @@ async def run_container(meta: DockerMeta, container: ContainerMeta) -> DockerCon
     if container.ipv6_forwarding:
         sysctls["net.ipv6.conf.all.forwarding"] = "1"
 
-    async with aiodocker.Docker() as client:
-        box = await client.containers.create(
-            name=get_full_object_name(meta.user_id, container.name),
-            config={
-                "AttachStdout": False,
-                "AttachStderr": False,
-                "Image": container.image,
-                "Env": [f"{key}={value}" for key, value in environment.items()],
-                "Labels": {"user_id": f"{meta.user_id}", "chapter": meta.chapter},
-                "HostConfig": {
-                    "CapAdd": ["NET_ADMIN", "NET_RAW"],
-                    "Memory": container.mem_limit,
-                    "Sysctls": sysctls,
-                    **host_options,
-                },
-                **options,
-            },
-        )
+    config: dict[str, Any] = {
+        "AttachStdout": False,
+        "AttachStderr": False,
+        "Image": container.image,
+        "Env": [f"{key}={value}" for key, value in environment.items()],
+        "Labels": owner.labels,
+        "HostConfig": {
+            "CapAdd": ["NET_ADMIN", "NET_RAW"],
+            "Memory": container.mem_limit,
+            "Sysctls": sysctls,
+            **host_options,
+        },
+        **options,
+    }
 
-        for network in networks:
-            docker_network = await client.networks.get(
-                get_full_object_name(meta.user_id, network.network_name)
-            )
-            await docker_network.connect(
-                {
-                    "Container": box.id,
-                    "EndpointConfig": kathara_endpoint_config(network),
-                }
-            )
+    # Later connections are part of the configuration as well
+    digest = config_hash(
+        {
+            "config": config,
+            "networks": [
+                (network_owner.object_name(network.network_name), asdict(network))
+                for network in networks
+            ],
+        }
+    )
+    config["Labels"] = {**owner.labels, "config_hash": digest}
+
+    return config, networks
+
+
+async def create_container(
+    container: ContainerMeta,
+    owner: Owner,
+    meta: DockerMeta | None = None,
+    network_owner: Owner | None = None,
+) -> tuple[DockerContainer, list[ContainerNetworkMeta]]:
+    """Creates a container attached to its first network (or to the host bridge).
+    Returns the container and the networks it still has to be connected to.
+
+    VPN containers need `meta` for certificates and port. Networks are looked up
+    by `network_owner` names, which default to the container owner."""
+    config, networks = container_config(container, owner, meta, network_owner)
+    client = get_docker(owner.node)
+    name = owner.object_name(container.name)
+
+    try:
+        box = await client.containers.create(name=name, config=config)
+    except DockerError as exc:
+        # Pinned images are missing on nodes which have not been prewarmed
+        if exc.status != 404 or await pull(owner.node, container.image) is None:
+            raise
+        box = await client.containers.create(name=name, config=config)
+
+    return box, networks
 
-        await box.start()
+
+async def connect_network(
+    network_owner: Owner, box: DockerContainer, network: ContainerNetworkMeta
+) -> None:
+    docker_network = await get_docker(network_owner.node).networks.get(
+        network_owner.object_name(network.network_name)
+    )
+    await docker_network.connect(
+        {
+            "Container": box.id,
+            "EndpointConfig": kathara_endpoint_config(network),
+        }
+    )
+
+
+async def run_container(meta: DockerMeta, container: ContainerMeta) -> DockerContainer:
+    owner = Owner.user(meta)
+    box, networks = await create_container(container, owner, meta)
+
+    for network in networks:
+        await connect_network(owner, box, network)
+
+    await box.start()
 
     return box
 
 
+async def deploy(
+    deployment: Deployment,
+    owner: Owner,
+    meta: DockerMeta | None = None,
+    network_owner: Owner | None = None,
+) -> None:
+    """
+    Creates all networks and containers of the deployment on behalf of `owner`.
+    Containers are attached to networks of `network_owner`, see `create_container`.
+
+    Steps form a dependency graph: a container is created as soon as the network it
+    is attached to at creation time exists, it is connected to every other network
+    as soon as that network exists, and it is started after all its connections.
+    Independent steps run concurrently, at most `LAUNCH_CONCURRENCY` at a time.
+    """
+
+    network_owner = network_owner or owner
+    semaphore = asyncio.Semaphore(LAUNCH_CONCURRENCY)
+
+    network_tasks = {
+        network.name: asyncio.ensure_future(
+            bounded(
+                semaphore,
+                measured(create_network(network_owner, network), "create_network"),
+            )
+        )
+        for network in deployment.networks
+    }
+
+    async def wait_network(network: ContainerNetworkMeta) -> None:
+        # Networks missing from deployment are expected to exist already
+        if network.network_name in network_tasks:
+            await network_tasks[network.network_name]
+
+    async def attach(
+        container: ContainerMeta, box: DockerContainer, network: ContainerNetworkMeta
+    ) -> None:
+        await wait_network(network)
+        await bounded(
+            semaphore,
+            measured(
+                connect_network(network_owner, box, network),
+                "connect_network",
+                container.image,
+            ),
+        )
+
+    async def run(container: ContainerMeta) -> None:
+        if not container.bridge:
+            await wait_network(container.networks[0])
+
+        box, networks = await bounded(
+            semaphore,
+            measured(
+                create_container(container, owner, meta, network_owner),
+                "create_container",
+                container.image,
+            ),
+        )
+        await gather_cancelling(
+            *(attach(container, box, network) for network in networks)
+        )
+        await bounded(
+            semaphore, measured(box.start(), "start_container", container.image)
+        )
+
+    await gather_cancelling(
+        *network_tasks.values(),
+        *(run(container) for container in deployment.containers),
+    )
+
+
 async def lock_meta(
     session: AsyncSession,
     user_id: int,
     chapter: str | None,
     assert_chapter: bool = False,
+    expected_state: DockerState | None = None,
 ) -> DockerMeta:
     meta = (
         await session.scalars(
@@ -156,6 +361,10 @@ async def lock_meta(
         await session.rollback()
         raise DockerConflict()
 
+    if expected_state is not None and (meta is None or meta.state != expected_state):
+        await session.rollback()
+        raise DockerConflict()
+
     if meta is None:
         meta = DockerMeta(
             user_id=user_id, chapter=chapter, state=DockerState.IN_PROGRESS
@@ -177,75 +386,487 @@ async def lock_meta(
     return meta
 
 
-async def clean(user_id: int) -> None:
-    async with aiodocker.Docker() as client:
-        containers = await client.containers.list(
-            all=True, filters={"label": [f"user_id={user_id}"]}
+async def remove_objects(label: str, node: str | None = None) -> None:
+    """Removes all containers and networks matching the label filter."""
+    client = get_docker(node)
+
+    containers = await client.containers.list(all=True, filters={"label": [label]})
+    await asyncio.gather(
+        *(container.delete(force=True, v=True) for container in containers)
+    )
+
+    # Networks can be removed only after all containers are detached
+    networks = await client.networks.list(filters={"label": label})
+    await asyncio.gather(
+        *(DockerNetwork(client, network["Id"]).delete() for network in networks)
+    )
+
+
+async def clean(user_id: int, node: str | None = None) -> None:
+    await remove_objects(f"user_id={user_id}", node)
+
+
+async def stop_containers(user_id: int, node: str | None = None) -> None:
+    """Stops containers of the user, keeping them to be started again."""
+    containers = await get_docker(node).containers.list(
+        filters={"label": [f"user_id={user_id}"]}
+    )
+    await asyncio.gather(*(box.stop() for box in containers))
+
+
+async def release_pool_slots(session: AsyncSession, user_id: int) -> None:
+    """Removes pooled deployments claimed by the user. Must be called after `clean`,
+    as user VPN container is attached to pooled networks."""
+    slots = (
+        await session.scalars(
+            select(DockerPoolSlot).where(DockerPoolSlot.user_id == user_id)
+        )
+    ).all()
+
+    for slot in slots:
+        await remove_objects(f"pool_slot={slot.id}", slot.node)
+        await session.delete(slot)
+
+
+async def has_pool_slots(session: AsyncSession, user_id: int) -> bool:
+    pooled = await session.scalar(
+        select(func.count(DockerPoolSlot.id)).where(DockerPoolSlot.user_id == user_id)
+    )
+    return bool(pooled)
+
+
+async def reconcile(
+    deployment: Deployment, meta: DockerMeta, resume: bool = False
+) -> Deployment:
+    """Compares objects of the user's deployment with the desired one. Removes
+    objects which differ in configuration or image, as well as containers which are
+    not running, and returns the part of the deployment that has to be created.
+    With `resume`, paused and stopped containers are kept and started again."""
+    owner = Owner.user(meta)
+    client = get_docker(owner.node)
+    label = f"user_id={meta.user_id}"
+
+    desired_networks = {
+        owner.object_name(network.name): (
+            network,
+            network_config(owner, network)["Labels"]["config_hash"],
         )
+        for network in deployment.networks
+    }
+    desired_containers = {
+        owner.object_name(container.name): (
+            container,
+            container_config(container, owner, meta)[0]["Labels"]["config_hash"],
+        )
+        for container in deployment.containers
+    }
 
-        for container in containers:
-            await container.delete(force=True, v=True)
+    async def image_id(image: str) -> str | None:
+        try:
+            return (await client.images.inspect(image))["Id"]
+        except DockerError:
+            return None
 
-        for network in await client.networks.list(
-            filters={"label": f"user_id={user_id}"}
+    images = list({container.image for container in deployment.containers})
+    image_ids = dict(
+        zip(images, await asyncio.gather(*map(image_id, images)), strict=True)
+    )
+
+    kept_networks: set[str] = set()
+    stale_networks: list[str] = []
+
+    for network in await client.networks.list(filters={"label": label}):
+        desired = desired_networks.get(network["Name"])
+        if (
+            desired is not None
+            and (network["Labels"] or {}).get("config_hash") == desired[1]
         ):
-            await DockerNetwork(client, network["Id"]).delete()
+            kept_networks.add(network["Name"])
+        else:
+            stale_networks.append(network["Id"])
+
+    kept_containers: dict[str, DockerContainer] = {}
+    stale_containers: list[DockerContainer] = []
 
+    for box in await client.containers.list(all=True, filters={"label": [label]}):
+        name = box["Names"][0].lstrip("/")
+        desired = desired_containers.get(name)
+
+        if (
+            desired is not None
+            and (box["Labels"] or {}).get("config_hash") == desired[1]
+            and box["ImageID"] == image_ids[desired[0].image]
+            and (
+                box["State"] == "running"
+                or (resume and box["State"] in ("paused", "exited"))
+            )
+            and all(
+                owner.object_name(network.network_name) in kept_networks
+                for network in desired[0].networks
+            )
+        ):
+            kept_containers[name] = box
+        else:
+            stale_containers.append(box)
+
+    logger.info(
+        "Reconciling deployment of user %d: keeping %d containers and %d networks",
+        meta.user_id,
+        len(kept_containers),
+        len(kept_networks),
+    )
+
+    await asyncio.gather(*(box.delete(force=True, v=True) for box in stale_containers))
+    # Networks can be removed only after all containers are detached
+    await asyncio.gather(
+        *(DockerNetwork(client, network_id).delete() for network_id in stale_networks)
+    )
 
+    await asyncio.gather(
+        *(
+            box.unpause()
+            for box in kept_containers.values()
+            if box["State"] == "paused"
+        ),
+        *(box.start() for box in kept_containers.values() if box["State"] == "exited"),
+    )
+
+    return Deployment(
+        containers=[
+            container
+            for name, (container, _) in desired_containers.items()
+            if name not in kept_containers
+        ],
+        networks=[
+            network
+            for name, (network, _) in desired_networks.items()
+            if name not in kept_networks
+        ],
+    )
+
+
+class Progress(Protocol):
+    """Receives phases of a launch or stop as they start, see `quirck.box.jobs`."""
+
+    async def __call__(self, phase: str, position: int | None = None) -> None: ...
+
+
+async def report(progress: Progress | None, phase: str, position: int | None = None):
+    if progress is not None:
+        await progress(phase, position)
+
+
+@timed("launch", "ready")
 async def launch(
-    session: AsyncSession, meta: DockerMeta, deployment: Deployment
+    session: AsyncSession,
+    meta: DockerMeta,
+    deployment: Deployment,
+    pool: "WarmPool | None" = None,
+    progress: Progress | None = None,
+    admission_wait: float = ADMISSION_WAIT,
+    reuse: bool = False,
 ) -> None:
-    """Expects that lock is taken elsewhere."""
+    """Expects that lock is taken elsewhere. If `pool` is given and has a deployment
+    ready, it is claimed instead of launching the deployment from scratch.
+
+    With `reuse`, objects left from the previous launch of the user which match the
+    deployment are kept and only the rest is recreated, see `reconcile`. This is not
+    possible for deployments claimed from a pool, which are always launched again.
+    Paused deployments are resumed this way, see `pause`.
+
+    The launch waits for admission first, see `quirck.box.admission`, unless a reused
+    deployment still holds its capacity. If it is still queued after a while,
+    `LaunchQueued` is raised and the instance is left disabled, or paused with the
+    objects kept if they are reused.
+    Once admitted, the deployment is placed on a node, see `quirck.box.placement`.
+    Images are replaced with their pinned IDs, see `quirck.box.images`. Phases are
+    timed, see `quirck.box.timing`.
+    """
 
     assert meta.state == DockerState.IN_PROGRESS
 
-    await clean(meta.user_id)
+    user_id = meta.user_id
+    declared = deployment
+    deployment = await pin_images(session, deployment)
+    declare_images(
+        {
+            pinned.image: container.image
+            for pinned, container in zip(
+                deployment.containers, declared.containers, strict=True
+            )
+        }
+    )
 
-    if meta.vpn is None:
-        meta.vpn = await generate_vpn(meta.user_id, meta.port)
+    paused_at = meta.paused_at
+    resume = paused_at is not None
+    meta.paused_at = None
+
+    if reuse or resume:
+        # Nothing to reuse if the deployment has never been placed
+        reuse = meta.node is not None and not await has_pool_slots(session, user_id)
+
+    # Reusing a deployment which has kept its ticket, requeueing it would only risk
+    # losing its capacity
+    admitted = reuse and await is_running(session, user_id)
+
+    if not reuse:
+        await report(progress, "cleaning")
+        with measure("cleaning"):
+            await clean(user_id, meta.node)
+            await release_pool_slots(session, user_id)
+
+    async def on_queued(position: int) -> None:
+        await report(progress, "queued", position)
+
+    try:
+        if not admitted:
+            with measure("admission"):
+                await admit(
+                    session,
+                    user_id,
+                    deployment_memory(deployment),
+                    wait=admission_wait,
+                    on_queued=on_queued,
+                )
+    except LaunchQueued:
+        # Nothing is running now, the user is expected to retry
+        now = datetime.now(timezone.utc)
+        if reuse:
+            # Objects are kept to be resumed on retry, like after a pause that
+            # has reclaimed memory
+            if not resume:
+                await stop_containers(user_id, meta.node)
+            meta.state = DockerState.PAUSED
+            meta.paused_at = paused_at or now
+        else:
+            meta.state = DockerState.DISABLED
+        meta.changed_at = now
         await session.commit()
+        raise
 
-    for network in deployment.networks:
-        await create_network(meta.user_id, network)
+    try:
+        if meta.vpn is None:
+            await report(progress, "credentials")
+            with measure("credentials"):
+                meta.vpn = await generate_vpn(user_id, session)
+        await session.commit()
+
+        await report(progress, "deploying")
+        if reuse:
+            with measure("reconcile"):
+                remaining = await reconcile(deployment, meta, resume)
+            with measure("deploying"):
+                await deploy(remaining, Owner.user(meta), meta)
+        else:
+            with measure("pool"):
+                claimed = pool is not None and await pool.claim(
+                    session, meta, deployment
+                )
 
-    for container in deployment.containers:
-        await run_container(meta, container)
+            if not claimed:
+                with measure("placement"):
+                    meta.node = await choose_node(
+                        session, deployment_memory(deployment)
+                    )
+                # Committed before deploying, so that a failed launch is cleaned up
+                await session.commit()
+
+                with measure("deploying"):
+                    await deploy(deployment, Owner.user(meta), meta)
+    except Exception:
+        await session.rollback()
+        await release(session, user_id)
+        await session.commit()
+        raise
 
     meta.state = DockerState.READY
     meta.changed_at = datetime.now(timezone.utc)
+    await mark_running(session, user_id)
     await session.commit()
 
 
-async def stop_locked(session: AsyncSession, meta: DockerMeta) -> None:
+async def reset(
+    session: AsyncSession,
+    user_id: int,
+    chapter: str | None,
+    deployment: Deployment,
+    name: str,
+    progress: Progress | None = None,
+) -> None:
+    """Recreates a single container of the user's deployment, e.g. a broken one,
+    keeping the rest of it."""
+    meta = await lock_meta(session, user_id, chapter, assert_chapter=True)
+
+    try:
+        await (
+            get_docker(meta.node)
+            .containers.container(get_full_object_name(user_id, name))
+            .delete(force=True, v=True)
+        )
+    except DockerError as exc:
+        if exc.status != 404:
+            raise
+
+    await launch(session, meta, deployment, progress=progress, reuse=True)
+
+
+@timed("stop", "stopped")
+async def stop_locked(
+    session: AsyncSession, meta: DockerMeta, progress: Progress | None = None
+) -> None:
     """Expects that lock is taken elsewhere."""
 
     assert meta.state == DockerState.IN_PROGRESS
 
-    await clean(meta.user_id)
+    await report(progress, "cleaning")
+    with measure("cleaning"):
+        await clean(meta.user_id, meta.node)
+        await release_pool_slots(session, meta.user_id)
+    await release(session, meta.user_id)
 
     meta.state = DockerState.DISABLED
     meta.changed_at = datetime.now(timezone.utc)
+    meta.paused_at = None
     await session.commit()
 
 
+async def pause(
+    session: AsyncSession, user_id: int, reclaim_memory: bool = False
+) -> bool:
+    """
+    Pauses containers of a ready deployment, so that they do not use CPU, and the
+    next launch resumes them instead of launching from scratch. With
+    `reclaim_memory`, containers are stopped instead, which frees their memory at
+    the cost of a slower resume.
+
+    Deployments claimed from a pool cannot be resumed and are stopped, as well as
+    those which fail to pause. Returns whether the deployment has been paused.
+    """
+    chapter = await session.scalar(
+        select(DockerMeta.chapter).where(DockerMeta.user_id == user_id)
+    )
+    meta = await lock_meta(
+        session,
+        user_id,
+        chapter,
+        assert_chapter=True,
+        expected_state=DockerState.READY,
+    )
+
+    if await has_pool_slots(session, user_id):
+        await stop_locked(session, meta)
+        return False
+
+    try:
+        if reclaim_memory:
+            await stop_containers(user_id, meta.node)
+        else:
+            containers = await get_docker(meta.node).containers.list(
+                filters={"label": [f"user_id={user_id}"]}
+            )
+            await asyncio.gather(*(box.pause() for box in containers))
+    except Exception:
+        logger.exception("Failed to pause deployment of user %d, stopping", user_id)
+        await stop_locked(session, meta)
+        return False
+
+    if reclaim_memory:
+        await release(session, user_id)
+
+    now = datetime.now(timezone.utc)
+    meta.state = DockerState.PAUSED
+    meta.changed_at = now
+    meta.paused_at = now
+    await session.commit()
+
+    return True
+
+
 async def stop(session: AsyncSession, user_id: int) -> None:
     meta = await lock_meta(session, user_id, None)
 
     await stop_locked(session, meta)
 
 
-async def stop_all(session: AsyncSession, chapter: str | None = None) -> None:
-    query = select(DockerMeta).where(DockerMeta.state == DockerState.READY)
+@dataclass
+class StopSummary:
+    stopped: dict[int, float] = Factory(dict)  # user id -> seconds spent
+    conflicted: list[int] = Factory(list)
+    failed: dict[int, str] = Factory(dict)  # user id -> error
+    elapsed: float = 0.0
+
+    def __str__(self) -> str:
+        summary = (
+            f"stopped {len(self.stopped)}, conflicted {len(self.conflicted)}, "
+            f"failed {len(self.failed)} in {self.elapsed:.1f}s"
+        )
+        if self.stopped:
+            timings = sorted(self.stopped.values())
+            summary += (
+                f" (per instance: median {timings[len(timings) // 2]:.1f}s,"
+                f" max {timings[-1]:.1f}s)"
+            )
+        return summary
+
+
+async def stop_many(
+    factory: async_sessionmaker[AsyncSession],
+    user_ids: Sequence[int],
+    concurrency: int = STOP_CONCURRENCY,
+    action: Callable[[AsyncSession, int], Awaitable[Any]] = stop,
+) -> StopSummary:
+    """Stops instances of given users, at most `concurrency` at a time, each in its
+    own session. Failures do not affect other stops and are reported in the summary.
+    Another `action` may be given, e.g. `pause`."""
+    semaphore = asyncio.Semaphore(concurrency)
+    summary = StopSummary()
+    loop = asyncio.get_running_loop()
+    started_at = loop.time()
+
+    async def stop_one(user_id: int) -> None:
+        async with semaphore, factory() as session:
+            stop_started_at = loop.time()
+            try:
+                await action(session, user_id)
+            except DockerConflict:
+                logger.warning("Could not stop user %d: state conflict", user_id)
+                summary.conflicted.append(user_id)
+            except Exception as exc:
+                logger.error("Error stopping user %d: %s", user_id, exc, exc_info=True)
+                summary.failed[user_id] = repr(exc)
+            else:
+                summary.stopped[user_id] = loop.time() - stop_started_at
+
+    await asyncio.gather(*(stop_one(user_id) for user_id in user_ids))
+
+    summary.elapsed = loop.time() - started_at
+    return summary
+
+
+async def stop_all(
+    session: AsyncSession,
+    chapter: str | None = None,
+    concurrency: int = STOP_CONCURRENCY,
+) -> StopSummary:
+    # Paused and failed deployments keep their objects too
+    query = select(DockerMeta.user_id).where(
+        DockerMeta.state.in_(
+            (DockerState.READY, DockerState.PAUSED, DockerState.FAILED)
+        )
+    )
     if chapter:
         query = query.where(DockerMeta.chapter == chapter)
 
-    candidates = (await session.scalars(query)).all()
+    user_ids = (await session.scalars(query)).all()
+    # Close the transaction, stops use their own sessions
+    await session.rollback()
 
-    for candidate in candidates:
-        try:
-            await stop(session, candidate.user_id)
-        except DockerConflict:
-            logger.warning("Could not stop %s due to lock", candidate.user_id)
+    summary = await stop_many(
+        async_sessionmaker(session.bind, expire_on_commit=False), user_ids, concurrency
+    )
+    logger.info("Stopped instances of %s: %s", chapter or "all chapters", summary)
+
+    return summary
 
 
 class ExecResult:
@@ -283,95 +904,216 @@ async def find_active_dockers(session: AsyncSession) -> Sequence[DockerMeta]:
     ).all()
 
 
-@dataclass
-class ClientStatPoint:
-    client_ip: str
-    connected_at: datetime
-    bytes_recv: int
-    bytes_sent: int
+def parse_openvpn_status(user_id: int, status: str) -> list[ClientStatPoint]:
+    """Parses client list of OpenVPN status (version 1 format)."""
+    recorded_at: datetime = datetime.now(timezone.utc)
+    in_client_list = False
+    points: list[ClientStatPoint] = []
 
+    for line in status.strip().split("\n"):
+        if line.startswith("Updated,"):
+            recorded_at = datetime.strptime(
+                line.split(",")[1], "%Y-%m-%d %H:%M:%S"
+            ).replace(tzinfo=timezone.utc)
+            continue
 
-async def update_client_stats(session: AsyncSession, docker: DockerMeta) -> None:
+        if line.startswith("Common Name,Real Address"):
+            in_client_list = True
+            continue
+
+        elif line.startswith("ROUTING TABLE"):
+            in_client_list = False
+            break
+
+        if in_client_list and line.strip():
+            parts = line.split(",")
+            if len(parts) >= 5:
+                client_ip = parts[1]
+                bytes_received = int(parts[2])
+                bytes_sent = int(parts[3])
+                connected_since = parts[4]
+
+                connected_at = datetime.strptime(
+                    connected_since, "%Y-%m-%d %H:%M:%S"
+                ).replace(tzinfo=timezone.utc)
+
+                points.append(
+                    ClientStatPoint(
+                        client_ip=client_ip,
+                        connected_at=connected_at,
+                        bytes_recv=bytes_received,
+                        bytes_sent=bytes_sent,
+                        recorded_at=recorded_at,
+                    )
+                )
+            else:
+                logger.warning(
+                    "Unexpected line format in VPN status for user %d: %s",
+                    user_id,
+                    line,
+                )
+
+    return points
+
+
+async def collect_client_stats(
+    docker: DockerMeta, collector: ManagementCollector | None = None
+) -> list[ClientStatPoint]:
     """
-    Update the client statistics for the VPN container of a given user.
+    Reads client statistics from the VPN container of a given user. With `collector`,
+    statistics are read through the management interface if the container has one
+    and is on a local node, otherwise status file is read with `docker exec`. The
+    status file is read as well if the management interface is not available, e.g.
+    with an outdated relay image.
     """
-    async with aiodocker.Docker() as client:
-        containers = await client.containers.list(
-            filters={"name": [get_full_object_name(docker.user_id, "vpn")]}
+    if (
+        collector is not None
+        and docker.vpn
+        and "MANAGEMENT_PASSWORD" in docker.vpn
+        # The interface is not published, only bridge addresses of the node reach it
+        and get_node(docker.node).local
+    ):
+        try:
+            status = await collector.status(
+                get_full_object_name(docker.user_id, "vpn"),
+                docker.vpn["MANAGEMENT_PASSWORD"],
+                docker.node,
+            )
+        except DockerError as exc:
+            if exc.status == 404:
+                return []
+            raise
+        except (OSError, ManagementError) as exc:
+            logger.warning(
+                "Management interface of user %d is not available, reading status "
+                "file: %s",
+                docker.user_id,
+                exc,
+            )
+        else:
+            return parse_openvpn_status(docker.user_id, status)
+
+    containers = await get_docker(docker.node).containers.list(
+        filters={"name": [get_full_object_name(docker.user_id, "vpn")]}
+    )
+
+    if not containers:
+        return []
+
+    container = containers[0]
+
+    execution = await container.exec(["/bin/cat", "/openvpn-status"])
+    result = await exec_command(execution)
+
+    if result.exit_code != 0:
+        logger.error(
+            "Failed to get VPN status for user %d: %s",
+            docker.user_id,
+            result.stderr.decode(errors="replace"),
         )
+        return []
 
-        if not containers:
-            return
+    return parse_openvpn_status(
+        docker.user_id, result.stdout.decode("utf-8", errors="replace")
+    )
 
-        container = containers[0]
 
-        execution = await container.exec(["/bin/cat", "/openvpn-status"])
-        result = await exec_command(execution)
+async def store_client_stats(
+    session: AsyncSession, points: list[tuple[DockerMeta, ClientStatPoint]]
+) -> None:
+    """Inserts all points with a single statement."""
+    if not points:
+        return
 
-        if result.exit_code != 0:
-            logger.error(
-                "Failed to get VPN status for user %d: %s",
-                docker.user_id,
-                result.stderr.decode(errors="replace"),
-            )
-            return
+    await ensure_partitions(
+        session.bind,
+        {point.recorded_at.astimezone(timezone.utc).date() for _, point in points},
+    )
 
-        lines = result.stdout.decode("utf-8", errors="replace").strip().split("\n")
+    await session.execute(
+        insert(DockerClientStats),
+        [
+            {
+                "docker_id": docker.port,
+                "client_ip": point.client_ip,
+                "connected_at": point.connected_at,
+                "bytes_recv": point.bytes_recv,
+                "bytes_sent": point.bytes_sent,
+                "recorded_at": point.recorded_at,
+            }
+            for docker, point in points
+        ],
+    )
 
-        recorded_at: datetime = datetime.now(timezone.utc)
-        in_client_list = False
 
-        for line in lines:
-            if line.startswith("Updated,"):
-                recorded_at = datetime.strptime(
-                    line.split(",")[1], "%Y-%m-%d %H:%M:%S"
-                ).replace(tzinfo=timezone.utc)
-                continue
+async def update_client_stats(session: AsyncSession, docker: DockerMeta) -> None:
+    """
+    Update the client statistics for the VPN container of a given user.
+    """
+    points = await collect_client_stats(docker)
 
-            if line.startswith("Common Name,Real Address"):
-                in_client_list = True
-                continue
+    await store_client_stats(session, [(docker, point) for point in points])
+    await session.commit()
 
-            elif line.startswith("ROUTING TABLE"):
-                in_client_list = False
-                break
 
-            if in_client_list and line.strip():
-                parts = line.split(",")
-                if len(parts) >= 5:
-                    client_ip = parts[1]
-                    bytes_received = int(parts[2])
-                    bytes_sent = int(parts[3])
-                    connected_since = parts[4]
+async def update_all_client_stats(
+    session: AsyncSession,
+    dockers: Sequence[DockerMeta],
+    concurrency: int = 16,
+    timeout: float = 10,
+    collector: ManagementCollector | None = None,
+    recorder: ChangeRecorder | None = None,
+) -> None:
+    """
+    Collects statistics of all given containers, at most `concurrency` at a time,
+    and stores them at once. Containers that fail or do not respond in `timeout`
+    seconds are skipped until the next pass. With `recorder`, only samples with
+    changed counters and heartbeats are stored.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def collect(docker: DockerMeta) -> list[tuple[DockerMeta, ClientStatPoint]]:
+        try:
+            points = await bounded(
+                semaphore,
+                asyncio.wait_for(collect_client_stats(docker, collector), timeout),
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Timed out getting VPN status for user %d", docker.user_id)
+            return []
+        except Exception:
+            logger.exception("Failed to get VPN status for user %d", docker.user_id)
+            return []
+
+        return [(docker, point) for point in points]
 
-                    connected_at = datetime.strptime(
-                        connected_since, "%Y-%m-%d %H:%M:%S"
-                    ).replace(tzinfo=timezone.utc)
+    collected = await asyncio.gather(*(collect(docker) for docker in dockers))
+    points = [item for items in collected for item in items]
 
-                    stats = DockerClientStats(
-                        docker_id=docker.port,
-                        client_ip=client_ip,
-                        connected_at=connected_at,
-                        bytes_recv=bytes_received,
-                        bytes_sent=bytes_sent,
-                        recorded_at=recorded_at,
-                    )
-                    session.add(stats)
-                else:
-                    logger.warning(
-                        "Unexpected line format in VPN status for user %d: %s",
-                        docker.user_id,
-                        line,
-                    )
+    if recorder is not None:
+        points = await recorder.select(session, points)
 
-        await session.commit()
+    await store_client_stats(session, points)
+    await session.commit()
 
 
 async def cleanup_client_stats(session: AsyncSession) -> None:
-    cutoff_time = datetime.now(timezone.utc) - timedelta(days=7)
-    await session.execute(
-        delete(DockerClientStats).where(DockerClientStats.recorded_at < cutoff_time)
-    )
+    """Rolls recent samples up into hourly aggregates and drops expired data."""
+    await rollup_client_stats(session)
+
+    dropped = await drop_expired_partitions(session)
+    if dropped:
+        logger.info("Dropped client stats partitions: %s", ", ".join(dropped))
+
+    await delete_expired_rollups(session)
+    await session.commit()
+
+
+@dataclass
+class ReapCandidate:
+    user_id: int
+    reason: str
+    state: DockerState
 
 
 async def find_instances_to_reap(
@@ -380,7 +1122,9 @@ async def find_instances_to_reap(
     reap_disconnected_for_minutes: int | None = 60,
     reap_low_traffic_for_minutes: int | None = 60,
     reap_inactive_if_older: int = 90,
-) -> list[int]:
+    reap_paused_for_minutes: int | None = 24 * 60,
+    reap_failed_for_minutes: int = 30,
+) -> list[ReapCandidate]:
     """
     Finds containers if one of following criterias is true:
 
@@ -395,117 +1139,162 @@ async def find_instances_to_reap(
 
     Low traffic means that there is no client that sent plus received at least 1 KB/min
     in some recording during last `reap_low_traffic_for_minutes` minutes.
+
+    Failed deployments (see `quirck.box.events`) are reaped after
+    `reap_failed_for_minutes` minutes, so that students may look into or reset them,
+    paused ones (see `pause`) are reaped after `reap_paused_for_minutes` minutes
+    (if set).
+
+    All criteria are evaluated by a single query, so statistics are never loaded.
+    Connections are looked up in hourly rollups, so `cleanup_client_stats` should
+    run before. Traffic is computed from raw samples of the recent partitions only.
     """
 
-    to_reap: list[int] = []
     now = datetime.now(timezone.utc)
+    running_for = DockerMeta.changed_at < now - timedelta(
+        minutes=reap_inactive_if_older
+    )
 
-    ready_containers = await find_active_dockers(session)
-
-    for docker in ready_containers:
-        running_minutes = (now - docker.changed_at).total_seconds() / 60
+    if reap_older_than_minutes is not None:
+        too_old = DockerMeta.changed_at < now - timedelta(
+            minutes=reap_older_than_minutes
+        )
+    else:
+        too_old = false()
+
+    query = select(DockerMeta.user_id, DockerMeta.state, DockerMeta.changed_at)
+
+    if reap_disconnected_for_minutes is not None:
+        cutoff = now - timedelta(minutes=reap_disconnected_for_minutes)
+        connected = (
+            select(DockerClientStatsHourly.docker_id)
+            .where(
+                DockerClientStatsHourly.hour
+                >= cutoff.replace(minute=0, second=0, microsecond=0),
+                DockerClientStatsHourly.last_recorded_at >= cutoff,
+            )
+            .group_by(DockerClientStatsHourly.docker_id)
+            .subquery("connected")
+        )
+        query = query.outerjoin(connected, connected.c.docker_id == DockerMeta.port)
+        disconnected = connected.c.docker_id.is_(None)
+    else:
+        disconnected = false()
+
+    if reap_low_traffic_for_minutes is not None:
+        traffic = DockerClientStats.bytes_recv + DockerClientStats.bytes_sent
+        window = {
+            "partition_by": (
+                DockerClientStats.docker_id,
+                DockerClientStats.client_ip,
+                DockerClientStats.connected_at,
+            ),
+            "order_by": DockerClientStats.recorded_at,
+        }
 
-        if (
-            reap_older_than_minutes is not None
-            and running_minutes > reap_older_than_minutes
-        ):
-            logger.info(
-                "Reaping container for user %d: running for %.1f minutes (threshold: %d)",
-                docker.user_id,
-                running_minutes,
-                reap_older_than_minutes,
+        samples = (
+            select(
+                DockerClientStats.docker_id,
+                (traffic - func.lag(traffic).over(**window)).label("traffic"),
+                func.extract(
+                    "epoch",
+                    DockerClientStats.recorded_at
+                    - func.lag(DockerClientStats.recorded_at).over(**window),
+                ).label("elapsed"),
             )
-            to_reap.append(docker.user_id)
-            continue
+            .where(
+                DockerClientStats.recorded_at
+                >= now - timedelta(minutes=reap_low_traffic_for_minutes),
+                DockerClientStats.docker_id.in_(
+                    select(DockerMeta.port).where(DockerMeta.state == DockerState.READY)
+                ),
+            )
+            .subquery("samples")
+        )
 
-        if running_minutes > reap_inactive_if_older:
-            should_reap = False
-            reason = ""
+        # 17 bytes/sec is about 1 KB/min
+        active = (
+            select(samples.c.docker_id)
+            .where(samples.c.elapsed > 0, samples.c.traffic >= 17 * samples.c.elapsed)
+            .group_by(samples.c.docker_id)
+            .subquery("active")
+        )
+        query = query.outerjoin(active, active.c.docker_id == DockerMeta.port)
+        low_traffic = active.c.docker_id.is_(None)
+    else:
+        low_traffic = false()
 
-            if reap_disconnected_for_minutes is not None:
-                cutoff_time = now - timedelta(minutes=reap_disconnected_for_minutes)
+    failed = and_(
+        DockerMeta.state == DockerState.FAILED,
+        DockerMeta.changed_at <= now - timedelta(minutes=reap_failed_for_minutes),
+    )
 
-                has_recent_stats = await session.scalar(
-                    select(DockerClientStats)
-                    .where(
-                        DockerClientStats.docker_id == docker.port,
-                        DockerClientStats.recorded_at >= cutoff_time,
-                    )
-                    .exists()
-                    .select()
-                )
+    if reap_paused_for_minutes is not None:
+        paused_too_long = and_(
+            DockerMeta.state == DockerState.PAUSED,
+            DockerMeta.changed_at < now - timedelta(minutes=reap_paused_for_minutes),
+        )
+    else:
+        paused_too_long = false()
+
+    query = query.add_columns(
+        failed.label("failed"),
+        paused_too_long.label("paused_too_long"),
+        too_old.label("too_old"),
+        disconnected.label("disconnected"),
+        low_traffic.label("low_traffic"),
+    ).where(
+        or_(
+            failed,
+            paused_too_long,
+            and_(
+                DockerMeta.state == DockerState.READY,
+                or_(too_old, and_(running_for, or_(disconnected, low_traffic))),
+            ),
+        )
+    )
 
-                if not has_recent_stats:
-                    should_reap = True
-                    reason = f"no clients connected in last {reap_disconnected_for_minutes} minutes"
-
-            if not should_reap and reap_low_traffic_for_minutes is not None:
-                cutoff_time = now - timedelta(minutes=reap_low_traffic_for_minutes)
-                traffic_stats = (
-                    await session.scalars(
-                        select(DockerClientStats)
-                        .where(
-                            DockerClientStats.docker_id == docker.port,
-                            DockerClientStats.recorded_at >= cutoff_time,
-                        )
-                        .order_by(
-                            DockerClientStats.client_ip, DockerClientStats.recorded_at
-                        )
-                    )
-                ).all()
-
-                has_active_client = False
-
-                last_client_id: tuple = tuple()
-                last_timestamp: datetime | None = None
-                last_traffic: int | None = None
-
-                for point in traffic_stats:
-                    current_client_id = (point.client_ip, point.connected_at)
-
-                    if (
-                        last_client_id == current_client_id
-                        and last_timestamp is not None
-                        and last_traffic is not None
-                    ):
-                        traffic = (point.bytes_recv + point.bytes_sent) - last_traffic
-                        time_diff = (point.recorded_at - last_timestamp).total_seconds()
-
-                        if (
-                            time_diff > 0 and traffic / time_diff >= 17
-                        ):  # 17 bytes/sec is about 1 KB/min
-                            has_active_client = True
-                            break
-
-                    last_client_id = current_client_id
-                    last_timestamp = point.recorded_at
-                    last_traffic = point.bytes_recv + point.bytes_sent
-
-                if not has_active_client:
-                    should_reap = True
-                    reason = (
-                        f"low traffic in last {reap_low_traffic_for_minutes} minutes"
-                    )
+    to_reap: list[ReapCandidate] = []
 
-            if should_reap:
-                logger.info(
-                    "Reaping container for user %d: running for %.1f minutes (inactive threshold: %d), %s",
-                    docker.user_id,
-                    running_minutes,
-                    reap_inactive_if_older,
-                    reason,
-                )
-                to_reap.append(docker.user_id)
+    for row in await session.execute(query):
+        running_minutes = (now - row.changed_at).total_seconds() / 60
+
+        if row.failed:
+            reason = f"failed more than {reap_failed_for_minutes} minutes ago"
+        elif row.paused_too_long:
+            reason = f"paused longer than {reap_paused_for_minutes} minutes"
+        elif row.too_old:
+            reason = f"running longer than {reap_older_than_minutes} minutes"
+        elif row.disconnected:
+            reason = (
+                f"no clients connected in last {reap_disconnected_for_minutes} minutes"
+            )
+        else:
+            reason = f"low traffic in last {reap_low_traffic_for_minutes} minutes"
+
+        logger.info(
+            "Reaping container for user %d: running for %.1f minutes, %s",
+            row.user_id,
+            running_minutes,
+            reason,
+        )
+        to_reap.append(ReapCandidate(row.user_id, reason, row.state))
 
     return to_reap
 
 
 __all__ = [
     "launch",
+    "pause",
+    "reset",
     "stop",
     "stop_all",
+    "stop_many",
+    "StopSummary",
     "cleanup_client_stats",
     "find_active_dockers",
     "find_instances_to_reap",
+    "ReapCandidate",
     "update_client_stats",
+    "update_all_client_stats",
 ]
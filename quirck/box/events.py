@@ -0,0 +1,216 @@
+"""
+Consumer of Docker events keeping `DockerMeta.state` in sync with containers.
+
+Containers of a ready deployment may die, be killed by OOM or be removed out of
+band. The consumer records such events in `docker_event` and marks the deployment
+as failed right away, so that neither the UI nor the reaper have to poll Docker.
+Run a single consumer per Docker node, see `quirck.box.client`:
+
+    python -m quirck.box.events [--node NAME]
+"""
+
+import argparse
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any
+
+from aiodocker.utils import clean_filters
+from attr import dataclass
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.client import close_docker, get_docker, get_node
+from quirck.box.docker import remove_objects
+from quirck.box.model import DockerEvent, DockerMeta, DockerPoolSlot, DockerState
+from quirck.core import config
+from quirck.core.config import DATABASE_URL
+from quirck.db.engine import get_engine
+
+logger = logging.getLogger(__name__)
+
+WATCHED_ACTIONS = ("die", "oom", "destroy")
+
+# Seconds to wait before resubscribing after the stream has ended
+RECONNECT_DELAY = 5
+
+
+@dataclass
+class ContainerEvent:
+    container: str
+    action: str
+    attributes: dict[str, str]
+    exit_code: int | None
+    occurred_at: datetime
+
+    @property
+    def is_failure(self) -> bool:
+        """Containers exiting successfully may be one-shot, they are not failures.
+        OOM kills of a process usually leave the container running, those are only
+        recorded; if the container dies of it, a `die` event follows."""
+        if self.action == "oom":
+            return False
+        return self.action != "die" or self.exit_code != 0
+
+
+def parse_event(data: dict[str, Any]) -> ContainerEvent | None:
+    """Returns event of a container of this app, or None for anything else."""
+    if data.get("Type") != "container" or data.get("Action") not in WATCHED_ACTIONS:
+        return None
+
+    attributes = data.get("Actor", {}).get("Attributes", {})
+    name = attributes.get("name", "")
+
+    # Labels may be shared with other apps on the host, names are not
+    if not name.startswith(f"quirck-{config.APP_MODULE}-"):
+        return None
+
+    exit_code = attributes.get("exitCode")
+
+    return ContainerEvent(
+        container=name,
+        action=data["Action"],
+        attributes=attributes,
+        exit_code=int(exit_code) if exit_code is not None else None,
+        occurred_at=datetime.fromtimestamp(data["timeNano"] / 1e9, timezone.utc),
+    )
+
+
+async def resolve_user(session: AsyncSession, event: ContainerEvent) -> int | None:
+    """Finds the user the container belongs to. Broken unclaimed pooled
+    deployments are removed, so that the pool refills them."""
+    if "user_id" in event.attributes:
+        return int(event.attributes["user_id"])
+
+    if "pool_slot" not in event.attributes:
+        return None
+
+    slot = await session.get(DockerPoolSlot, int(event.attributes["pool_slot"]))
+    if slot is None:
+        return None
+
+    if slot.user_id is None and slot.state == DockerState.READY and event.is_failure:
+        logger.warning("Removing broken pooled slot %d", slot.id)
+        await remove_objects(f"pool_slot={slot.id}", slot.node)
+        await session.delete(slot)
+
+    return slot.user_id
+
+
+async def handle_event(
+    session: AsyncSession, event: ContainerEvent, node: str | None = None
+) -> None:
+    user_id = await resolve_user(session, event)
+
+    session.add(
+        DockerEvent(
+            user_id=user_id,
+            node=node,
+            container=event.container,
+            action=event.action,
+            exit_code=event.exit_code,
+            occurred_at=event.occurred_at,
+        )
+    )
+
+    if user_id is not None and event.is_failure:
+        # Events of deployments being stopped or relaunched are not failures:
+        # those are in progress, or have changed state after the event
+        result = await session.execute(
+            update(DockerMeta)
+            .where(
+                DockerMeta.user_id == user_id,
+                DockerMeta.state == DockerState.READY,
+                DockerMeta.changed_at <= event.occurred_at,
+            )
+            .values(state=DockerState.FAILED, changed_at=datetime.now(timezone.utc))
+        )
+
+        if result.rowcount:
+            logger.warning(
+                "Deployment of user %d failed: %s %s (exit code %s)",
+                user_id,
+                event.container,
+                event.action,
+                event.exit_code,
+            )
+
+    await session.commit()
+
+
+async def watch(
+    factory: async_sessionmaker[AsyncSession], node: str | None = None
+) -> None:
+    """Consumes events of the node forever. Events missed while the consumer was
+    not running are replayed from the last recorded one."""
+    node = get_node(node).name
+    docker = get_docker(node)
+
+    async with factory() as session:
+        since = await session.scalar(
+            select(func.max(DockerEvent.occurred_at)).where(
+                func.coalesce(DockerEvent.node, get_node().name) == node
+            )
+        )
+
+    while True:
+        params = {
+            "filters": clean_filters(
+                {"type": ["container"], "event": list(WATCHED_ACTIONS)}
+            )
+        }
+        if since is not None:
+            params["since"] = str(int(since.timestamp()))
+
+        subscriber = docker.events.subscribe(**params)
+
+        try:
+            while (data := await subscriber.get()) is not None:
+                event = parse_event(data)
+                # `since` has a precision of seconds, skip events seen already
+                if event is None or (since is not None and event.occurred_at <= since):
+                    continue
+
+                try:
+                    async with factory() as session:
+                        await handle_event(session, event, node)
+                except Exception:
+                    logger.exception("Failed to handle event %s", data)
+
+                since = event.occurred_at
+        finally:
+            try:
+                await docker.events.stop()
+            except Exception:
+                logger.exception("Docker events stream failed")
+
+        logger.warning("Docker events stream ended, reconnecting")
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Track failures of containers")
+    parser.add_argument(
+        "--node", help="Docker node to watch (default: the first configured one)"
+    )
+
+    args = parser.parse_args()
+
+    engine = get_engine(DATABASE_URL)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        await watch(factory, args.node)
+    finally:
+        await close_docker()
+        await engine.dispose()
+
+
+__all__ = ["watch"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s"
+    )
+    asyncio.run(main())
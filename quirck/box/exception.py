@@ -9,4 +9,15 @@ class DockerConflict(HTTPException):
         )
 
 
-__all__ = ["DockerConflict"]
+class LaunchQueued(HTTPException):
+    def __init__(self, position: int, retry_after: int = 5):
+        self.position = position
+        super().__init__(
+            429,
+            f"Сейчас запускается много заданий. Ваш запуск в очереди под номером {position}, "
+            "повторите попытку через несколько секунд",
+            headers={"Retry-After": str(retry_after)},
+        )
+
+
+__all__ = ["DockerConflict", "LaunchQueued"]
@@ -0,0 +1,248 @@
+"""
+Images of deployments pulled ahead of time and pinned to their IDs.
+
+`prewarm` pulls images on every Docker node, so that launches do not wait for
+pulls, and pins each image name to the ID it has resolved to in `docker_image`.
+Launches replace names with pinned references (see `pin_images`), so a tag pushed
+during a session does not change labs until images are prewarmed again. Images
+from a registry are pinned to their digest, which a node missing the image, e.g.
+added after prewarming, pulls on creation of a container. Images built locally,
+such as the relay, can only be pinned to their ID.
+
+Images are declared by the app module as `box_images`, a mapping of chapter to
+image names. Images of warm pools and the VPN relay are always included. Run it
+once after pushing images, or permanently with `--interval`:
+
+    python -m quirck.box.images [--chapter CHAPTER] [--interval SECONDS]
+"""
+
+import argparse
+import asyncio
+import dataclasses
+import logging
+from datetime import datetime, timezone
+from typing import Any, Iterable
+
+from aiodocker.exceptions import DockerError
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.client import NODES, close_docker, get_docker
+from quirck.box.config import IMAGE_PULL_CONCURRENCY
+from quirck.box.meta import RELAY_IMAGE, Deployment
+from quirck.box.model import DockerImage
+from quirck.box.tasks import bounded
+from quirck.core.config import DATABASE_URL
+from quirck.db.engine import get_engine
+
+logger = logging.getLogger(__name__)
+
+
+def declared_images(app: Any, chapter: str | None = None) -> set[str]:
+    """Returns images used by the app, or by one chapter of it."""
+    images = {RELAY_IMAGE}
+
+    for image_chapter, names in getattr(app, "box_images", {}).items():
+        if chapter is None or image_chapter == chapter:
+            images.update(names)
+
+    for pool in getattr(app, "warm_pools", []):
+        if chapter is None or pool.chapter == chapter:
+            images.update(container.image for container in pool.deployment.containers)
+
+    return images
+
+
+def split_reference(image: str) -> tuple[str, str | None]:
+    """Splits an image reference into name and tag, which defaults to "latest" like
+    in `docker pull`. References with a digest have no tag."""
+    if "@" in image:
+        return image, None
+
+    name, _, tag = image.rpartition(":")
+    # A colon before the last slash belongs to the registry port
+    if not name or "/" in tag:
+        return image, "latest"
+
+    return name, tag
+
+
+async def pull(node: str | None, image: str) -> tuple[str, str | None] | None:
+    """Pulls the image on the node and returns its ID and digest reference, if it
+    comes from a registry. Images that cannot be pulled, e.g. built locally, are
+    still resolved if present."""
+    client = get_docker(node)
+    name, tag = split_reference(image)
+
+    try:
+        # Without a tag, the engine would pull all tags of the repository
+        await client.images.pull(name, tag=tag)
+    except DockerError as exc:
+        logger.warning("Failed to pull %s on %s: %s", image, node, exc)
+
+    try:
+        info = await client.images.inspect(image)
+    except DockerError:
+        logger.error("Image %s is not available on %s", image, node)
+        return None
+
+    digests = [
+        reference
+        for reference in info.get("RepoDigests") or []
+        if reference.partition("@")[0] == name
+    ]
+    return info["Id"], min(digests, default=None)
+
+
+async def prewarm(
+    session: AsyncSession,
+    images: Iterable[str],
+    concurrency: int = IMAGE_PULL_CONCURRENCY,
+) -> dict[str, str]:
+    """
+    Pulls images on all nodes, at most `concurrency` pulls at a time, and pins them.
+    An image is pinned only if every node has resolved it to the same ID, otherwise
+    the previous pin is kept. Returns the new pins.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    images = sorted(set(images))
+
+    async def resolve(image: str) -> tuple[str, str | None] | None:
+        pulled = set(
+            await asyncio.gather(
+                *(bounded(semaphore, pull(node, image)) for node in NODES)
+            )
+        )
+
+        if None in pulled:
+            return None
+
+        image_ids = {image_id for image_id, _ in pulled}
+        if len(image_ids) > 1:
+            logger.warning("Image %s differs between nodes, not pinning", image)
+            return None
+
+        # A node may lack the digest, e.g. if it has built the same image
+        digests = {digest for _, digest in pulled}
+        return image_ids.pop(), digests.pop() if len(digests) == 1 else None
+
+    resolved = dict(
+        zip(images, await asyncio.gather(*map(resolve, images)), strict=True)
+    )
+    pins = {image: pin for image, pin in resolved.items() if pin is not None}
+
+    if pins:
+        statement = insert(DockerImage).values(
+            [
+                {
+                    "image": image,
+                    "image_id": image_id,
+                    "digest": digest,
+                    "pinned_at": datetime.now(timezone.utc),
+                }
+                for image, (image_id, digest) in pins.items()
+            ]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=["image"],
+            set_={
+                "image_id": statement.excluded.image_id,
+                "digest": statement.excluded.digest,
+                "pinned_at": statement.excluded.pinned_at,
+            },
+            where=(DockerImage.image_id != statement.excluded.image_id)
+            | DockerImage.digest.is_distinct_from(statement.excluded.digest),
+        )
+        await session.execute(statement)
+        await session.commit()
+
+    for image, (image_id, digest) in pins.items():
+        logger.info("Pinned %s to %s", image, digest or image_id)
+
+    return {image: digest or image_id for image, (image_id, digest) in pins.items()}
+
+
+async def pin_images(session: AsyncSession, deployment: Deployment) -> Deployment:
+    """Replaces image names of the deployment with pinned digests, or IDs of images
+    without one. Images which have not been prewarmed are left as is."""
+    names = {container.image for container in deployment.containers}
+
+    pins = dict(
+        (
+            await session.execute(
+                select(
+                    DockerImage.image,
+                    func.coalesce(DockerImage.digest, DockerImage.image_id),
+                ).where(DockerImage.image.in_(names))
+            )
+        ).tuples()
+    )
+
+    return dataclasses.replace(
+        deployment,
+        containers=[
+            dataclasses.replace(
+                container, image=pins.get(container.image, container.image)
+            )
+            for container in deployment.containers
+        ],
+    )
+
+
+async def main():
+    from quirck.core.module import app
+
+    parser = argparse.ArgumentParser(description="Pull and pin images of chapters")
+    parser.add_argument(
+        "--chapter", type=str, help="Only process images of this chapter"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=IMAGE_PULL_CONCURRENCY,
+        help=f"Number of pulls at once (default: {IMAGE_PULL_CONCURRENCY})",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=0,
+        help="Keep running, prewarming every this many seconds (default: run once)",
+    )
+
+    args = parser.parse_args()
+
+    images = declared_images(app, args.chapter)
+
+    engine = get_engine(DATABASE_URL)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        while True:
+            logger.info("Prewarming %d images on %d nodes", len(images), len(NODES))
+
+            try:
+                async with factory() as session:
+                    await prewarm(session, images, args.concurrency)
+            except Exception:
+                if not args.interval:
+                    raise
+                logger.exception("Failed to prewarm images")
+
+            if not args.interval:
+                break
+
+            await asyncio.sleep(args.interval)
+    finally:
+        await close_docker()
+        await engine.dispose()
+
+
+__all__ = ["pin_images", "prewarm", "pull"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s"
+    )
+    asyncio.run(main())
@@ -0,0 +1,278 @@
+"""
+Launches and stops executed by background workers.
+
+Instead of running `launch` inside an HTTP request, a handler submits a job and
+returns at once. The instance is locked (moved to `IN_PROGRESS`) at submission, so
+conflicting requests fail right away with `DockerConflict`. Workers claim jobs
+with `SKIP LOCKED` and report the current phase to the job row, which clients
+poll via `box:job` route:
+
+    python -m quirck.box.jobs [--concurrency 4]
+
+Workers refresh the heartbeat of running jobs every `HEARTBEAT_INTERVAL`, however
+long they take, e.g. while queued for admission. Jobs without a heartbeat for
+`STALE_JOB_AGE` (e.g. after a worker crash) are claimed again; both launch and
+stop are idempotent.
+"""
+
+import argparse
+import asyncio
+import logging
+import math
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.client import close_docker
+from quirck.box.docker import launch, lock_meta, stop_locked
+from quirck.box.meta import Deployment
+from quirck.box.model import DockerJob, DockerMeta, DockerState, JobKind, JobState
+from quirck.box.pool import WarmPool
+from quirck.box.vpn import close_executor
+from quirck.core.config import DATABASE_URL
+from quirck.db.engine import get_engine
+
+logger = logging.getLogger(__name__)
+
+STALE_JOB_AGE = timedelta(minutes=5)
+
+# Seconds between heartbeats of a running job
+HEARTBEAT_INTERVAL = 30
+
+# Seconds between polls of an idle worker
+POLL_INTERVAL = 1
+
+
+async def submit_launch(
+    session: AsyncSession,
+    user_id: int,
+    chapter: str | None,
+    deployment: Deployment,
+    assert_chapter: bool = False,
+) -> DockerJob:
+    await lock_meta(session, user_id, chapter, assert_chapter)
+
+    job = DockerJob(
+        user_id=user_id,
+        kind=JobKind.LAUNCH,
+        state=JobState.QUEUED,
+        chapter=chapter,
+        deployment=deployment.dump(),
+    )
+    session.add(job)
+    await session.commit()
+
+    return job
+
+
+async def submit_stop(session: AsyncSession, user_id: int) -> DockerJob:
+    await lock_meta(session, user_id, None)
+
+    job = DockerJob(user_id=user_id, kind=JobKind.STOP, state=JobState.QUEUED)
+    session.add(job)
+    await session.commit()
+
+    return job
+
+
+async def claim_job(session: AsyncSession) -> DockerJob | None:
+    now = datetime.now(timezone.utc)
+
+    job = (
+        await session.scalars(
+            select(DockerJob)
+            .where(
+                or_(
+                    DockerJob.state == JobState.QUEUED,
+                    (DockerJob.state == JobState.RUNNING)
+                    & (
+                        func.coalesce(DockerJob.heartbeat_at, DockerJob.started_at)
+                        < now - STALE_JOB_AGE
+                    ),
+                )
+            )
+            .order_by(DockerJob.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+    ).one_or_none()
+
+    if job is None:
+        return None
+
+    if job.state == JobState.RUNNING:
+        logger.warning("Job %d seems to be abandoned, running it again", job.id)
+
+    job.state = JobState.RUNNING
+    job.started_at = now
+    job.heartbeat_at = now
+    job.phase = None
+    job.position = None
+    await session.commit()
+
+    return job
+
+
+async def update_job(
+    factory: async_sessionmaker[AsyncSession], job_id: int, **values
+) -> None:
+    async with factory() as session:
+        await session.execute(
+            update(DockerJob).where(DockerJob.id == job_id).values(**values)
+        )
+        await session.commit()
+
+
+async def beat(factory: async_sessionmaker[AsyncSession], job_id: int) -> None:
+    """Keeps the job from being claimed again while it runs."""
+    while True:
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+        try:
+            await update_job(factory, job_id, heartbeat_at=datetime.now(timezone.utc))
+        except Exception:
+            logger.exception("Failed to refresh heartbeat of job %d", job_id)
+
+
+async def run_job(
+    factory: async_sessionmaker[AsyncSession],
+    job: DockerJob,
+    pools: dict[str, WarmPool],
+) -> None:
+    heartbeat = asyncio.create_task(beat(factory, job.id))
+    try:
+        await execute_job(factory, job, pools)
+    finally:
+        heartbeat.cancel()
+
+
+async def execute_job(
+    factory: async_sessionmaker[AsyncSession],
+    job: DockerJob,
+    pools: dict[str, WarmPool],
+) -> None:
+    async def progress(phase: str, position: int | None = None) -> None:
+        await update_job(factory, job.id, phase=phase, position=position)
+
+    async with factory() as session:
+        meta = await session.scalar(
+            select(DockerMeta).where(DockerMeta.user_id == job.user_id)
+        )
+        if meta is None or meta.state != DockerState.IN_PROGRESS:
+            # E.g. an abandoned job which has actually finished
+            logger.warning("Instance of job %d is not in progress", job.id)
+            await update_job(
+                factory,
+                job.id,
+                state=JobState.FAILED,
+                error="Instance is not in progress",
+                finished_at=datetime.now(timezone.utc),
+            )
+            return
+
+        try:
+            if job.kind == JobKind.LAUNCH:
+                assert job.deployment is not None
+                await launch(
+                    session,
+                    meta,
+                    Deployment.load(job.deployment),
+                    pool=pools.get(job.chapter or ""),
+                    progress=progress,
+                    # Workers are not bound by request timeouts
+                    admission_wait=math.inf,
+                )
+            else:
+                await stop_locked(session, meta, progress)
+        except Exception as exc:
+            logger.exception("Job %d of user %d failed", job.id, job.user_id)
+
+            if job.kind == JobKind.LAUNCH:
+                await cleanup_failed_launch(session, job.user_id)
+
+            await update_job(
+                factory,
+                job.id,
+                state=JobState.FAILED,
+                error=repr(exc),
+                finished_at=datetime.now(timezone.utc),
+            )
+            return
+
+    await update_job(
+        factory,
+        job.id,
+        state=JobState.DONE,
+        phase=None,
+        position=None,
+        finished_at=datetime.now(timezone.utc),
+    )
+
+
+async def cleanup_failed_launch(session: AsyncSession, user_id: int) -> None:
+    """Removes whatever was created, so that the user can launch again."""
+    await session.rollback()
+
+    meta = await session.scalar(select(DockerMeta).where(DockerMeta.user_id == user_id))
+    if meta is None or meta.state != DockerState.IN_PROGRESS:
+        return
+
+    try:
+        await stop_locked(session, meta)
+    except Exception:
+        logger.exception("Failed to clean up after launch of user %d", user_id)
+
+
+async def work(
+    factory: async_sessionmaker[AsyncSession], pools: dict[str, WarmPool]
+) -> None:
+    while True:
+        async with factory() as session:
+            job = await claim_job(session)
+
+        if job is None:
+            await asyncio.sleep(POLL_INTERVAL)
+            continue
+
+        logger.info("Running %s job %d of user %d", job.kind.name, job.id, job.user_id)
+        try:
+            await run_job(factory, job, pools)
+        except Exception:
+            # The job is claimed again once it becomes stale
+            logger.exception("Failed to run job %d", job.id)
+
+
+async def main():
+    from quirck.core.module import app
+
+    parser = argparse.ArgumentParser(description="Execute launch and stop jobs")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=4,
+        help="Number of jobs executed at once (default: 4)",
+    )
+
+    args = parser.parse_args()
+
+    pools = {pool.chapter: pool for pool in getattr(app, "warm_pools", [])}
+
+    engine = get_engine(DATABASE_URL)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        await asyncio.gather(*(work(factory, pools) for _ in range(args.concurrency)))
+    finally:
+        await close_docker()
+        close_executor()
+        await engine.dispose()
+
+
+__all__ = ["submit_launch", "submit_stop"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s"
+    )
+    asyncio.run(main())
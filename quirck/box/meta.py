@@ -1,4 +1,7 @@
-from dataclasses import dataclass, field
+from dataclasses import asdict, dataclass, field
+from typing import Any
+
+RELAY_IMAGE = "ct-itmo/quirck-relay"
 
 
 @dataclass(frozen=True)
@@ -51,7 +54,7 @@ class ContainerMeta:
 
         return ContainerMeta(
             name="vpn",
-            image="ct-itmo/quirck-relay",
+            image=RELAY_IMAGE,
             networks=networks,
             bridge=True,
             vpn=True,
@@ -69,5 +72,27 @@ class Deployment:
     containers: list[ContainerMeta]
     networks: list[NetworkMeta]
 
+    def dump(self) -> dict[str, Any]:
+        """Converts the deployment to JSON-compatible form, e.g. to persist a job."""
+        return asdict(self)
+
+    @staticmethod
+    def load(data: dict[str, Any]) -> "Deployment":
+        return Deployment(
+            containers=[
+                ContainerMeta(
+                    **{
+                        **container,
+                        "networks": [
+                            ContainerNetworkMeta(**network)
+                            for network in container["networks"]
+                        ],
+                    }
+                )
+                for container in data["containers"]
+            ],
+            networks=[NetworkMeta(**network) for network in data["networks"]],
+        )
+
 
 __all__ = ["ContainerMeta", "Deployment", "NetworkMeta", "ContainerNetworkMeta"]
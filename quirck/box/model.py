@@ -6,10 +6,13 @@ from sqlalchemy import (
     BigInteger,
     DateTime,
     Enum,
+    Float,
     ForeignKey,
     Index,
+    Integer,
     String,
     Sequence,
+    Text,
     text,
 )
 from sqlalchemy.dialects.postgresql import JSONB
@@ -23,6 +26,10 @@ class DockerState(enum.Enum):
     IN_PROGRESS = 1
     READY = 2
     DISABLED = 3
+    # A container of a ready deployment has died or was removed, see `quirck.box.events`
+    FAILED = 4
+    # Containers of an idle deployment are paused or stopped, see `quirck.box.docker.pause`
+    PAUSED = 5
 
 
 class DockerMeta(Base):
@@ -42,18 +49,29 @@ class DockerMeta(Base):
     chapter: Mapped[str | None] = mapped_column(String(40), nullable=True)
     state: Mapped[DockerState] = mapped_column(Enum(DockerState), nullable=False)
     vpn: Mapped[dict[str, Any] | None] = mapped_column(JSONB, nullable=True)
+    # Docker node the deployment lives on, see `quirck.box.client`
+    node: Mapped[str | None] = mapped_column(String(64), nullable=True)
     changed_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), nullable=False, server_default=text("now()")
     )
+    # Set while the deployment is paused, the next launch resumes it
+    paused_at: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
 
     user = relationship("User", back_populates="docker_meta")
     client_stats = relationship("DockerClientStats", back_populates="docker_meta")
 
 
 class DockerClientStats(Base):
+    """Raw samples of VPN clients. The table is partitioned by day of `recorded_at`,
+    partitions are managed by `quirck.box.stats`."""
+
     __tablename__ = "docker_client_stats"
     __table_args__ = (
         Index("docker_client_stats_client", "docker_id", "client_ip", "connected_at"),
+        Index("docker_client_stats_recorded_at", "recorded_at"),
+        {"postgresql_partition_by": "RANGE (recorded_at)"},
     )
 
     id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
@@ -67,7 +85,10 @@ class DockerClientStats(Base):
         DateTime(timezone=True), nullable=False
     )
     recorded_at: Mapped[datetime] = mapped_column(
-        DateTime(timezone=True), nullable=False, server_default=text("now()")
+        DateTime(timezone=True),
+        primary_key=True,
+        nullable=False,
+        server_default=text("now()"),
     )
     bytes_recv: Mapped[int] = mapped_column(BigInteger, nullable=False)
     bytes_sent: Mapped[int] = mapped_column(BigInteger, nullable=False)
@@ -75,7 +96,257 @@ class DockerClientStats(Base):
     docker_meta = relationship("DockerMeta", back_populates="client_stats")
 
 
+class DockerClientStatsHourly(Base):
+    """Per-hour aggregates of `DockerClientStats` for a single client connection."""
+
+    __tablename__ = "docker_client_stats_hourly"
+
+    docker_id: Mapped[int] = mapped_column(
+        BigInteger,
+        ForeignKey("docker.port", onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    client_ip: Mapped[str] = mapped_column(String(64), primary_key=True)
+    connected_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True
+    )
+    hour: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), primary_key=True, index=True
+    )
+    samples: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    first_recorded_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    last_recorded_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    # Counters are cumulative, so these are their values at the last sample
+    bytes_recv: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    bytes_sent: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    # Bytes sent plus received between the first and the last sample of the hour
+    traffic: Mapped[int] = mapped_column(BigInteger, nullable=False)
+
+
+class DockerEvent(Base):
+    """Container events that affect deployments, recorded by `quirck.box.events`."""
+
+    __tablename__ = "docker_event"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int | None] = mapped_column(
+        BigInteger,
+        ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=True,
+        index=True,
+    )
+    node: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    container: Mapped[str] = mapped_column(String(255), nullable=False)
+    action: Mapped[str] = mapped_column(String(32), nullable=False)
+    exit_code: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    occurred_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, index=True
+    )
+
+
+class AdmissionState(enum.Enum):
+    QUEUED = 1
+    LAUNCHING = 2
+    RUNNING = 3
+
+
+class DockerAdmission(Base):
+    """Launch ticket of a user, see `quirck.box.admission`. Admitted tickets are kept
+    while the deployment runs, so that its memory is accounted."""
+
+    __tablename__ = "docker_admission"
+
+    user_id: Mapped[int] = mapped_column(
+        BigInteger,
+        ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"),
+        primary_key=True,
+    )
+    state: Mapped[AdmissionState] = mapped_column(
+        Enum(AdmissionState), nullable=False, index=True
+    )
+    memory: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    queued_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+    # Queued tickets are dropped if the user stops asking for them
+    touched_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    admitted_at: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+
+
+class JobKind(enum.Enum):
+    LAUNCH = 1
+    STOP = 2
+
+
+class JobState(enum.Enum):
+    QUEUED = 1
+    RUNNING = 2
+    DONE = 3
+    FAILED = 4
+
+
+class DockerJob(Base):
+    """Launch or stop executed by a background worker, see `quirck.box.jobs`."""
+
+    __tablename__ = "docker_job"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(
+        BigInteger,
+        ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    kind: Mapped[JobKind] = mapped_column(Enum(JobKind), nullable=False)
+    state: Mapped[JobState] = mapped_column(Enum(JobState), nullable=False, index=True)
+    chapter: Mapped[str | None] = mapped_column(String(40), nullable=True)
+    # Serialized `Deployment` for launches
+    deployment: Mapped[dict[str, Any] | None] = mapped_column(JSONB, nullable=True)
+    # Current phase reported by `launch` or `stop_locked`, and position in the
+    # admission queue while queued
+    phase: Mapped[str | None] = mapped_column(String(32), nullable=True)
+    position: Mapped[int | None] = mapped_column(Integer, nullable=True)
+    error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=text("now()")
+    )
+    started_at: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    # Refreshed by the worker while it runs the job
+    heartbeat_at: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+    finished_at: Mapped[datetime | None] = mapped_column(
+        DateTime(timezone=True), nullable=True
+    )
+
+
+class DockerPoolSlot(Base):
+    """Deployment launched ahead of time by a warm pool, see `quirck.box.pool`."""
+
+    __tablename__ = "docker_pool"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    chapter: Mapped[str] = mapped_column(String(40), nullable=False, index=True)
+    state: Mapped[DockerState] = mapped_column(Enum(DockerState), nullable=False)
+    node: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    user_id: Mapped[int | None] = mapped_column(
+        BigInteger,
+        ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=True,
+    )
+    # Memory limits of pooled containers, reserved while the slot exists
+    memory: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    changed_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=text("now()")
+    )
+
+
+class DockerImage(Base):
+    """Image names pinned to image IDs, see `quirck.box.images`."""
+
+    __tablename__ = "docker_image"
+
+    image: Mapped[str] = mapped_column(String(255), primary_key=True)
+    image_id: Mapped[str] = mapped_column(String(80), nullable=False)
+    # Registry reference with the digest, pullable unlike the ID
+    digest: Mapped[str | None] = mapped_column(String(512), nullable=True)
+    pinned_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), nullable=False)
+
+
+class DockerTiming(Base):
+    """Time spent in phases of a launch or stop, see `quirck.box.timing`."""
+
+    __tablename__ = "docker_timing"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(
+        BigInteger,
+        ForeignKey("user.id", onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False,
+        index=True,
+    )
+    operation: Mapped[str] = mapped_column(String(16), nullable=False)
+    chapter: Mapped[str | None] = mapped_column(String(40), nullable=True)
+    node: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    # "ready", "queued" or "failed" for launches, "stopped" or "failed" for stops
+    outcome: Mapped[str] = mapped_column(String(16), nullable=False)
+    started_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, index=True
+    )
+    total: Mapped[float] = mapped_column(Float, nullable=False)
+    # Phase name to seconds, concurrent Docker operations are summed up
+    phases: Mapped[dict[str, float]] = mapped_column(JSONB, nullable=False)
+    # Declared image name to its part of `phases`
+    image_phases: Mapped[dict[str, dict[str, float]] | None] = mapped_column(
+        JSONB(none_as_null=True), nullable=True
+    )
+
+
+class DockerTimingBucket(Base):
+    """Number and sum of phase durations within a bucket of the phase histogram,
+    updated as timings are stored, see `quirck.box.timing`."""
+
+    __tablename__ = "docker_timing_bucket"
+
+    operation: Mapped[str] = mapped_column(String(16), primary_key=True)
+    phase: Mapped[str] = mapped_column(String(64), primary_key=True)
+    # Empty for operations without a chapter, and for phases of all images
+    chapter: Mapped[str] = mapped_column(String(40), primary_key=True)
+    image: Mapped[str] = mapped_column(String(255), primary_key=True)
+    # Upper bound of the bucket, infinity for the last one
+    le: Mapped[float] = mapped_column(Float, primary_key=True)
+    count: Mapped[int] = mapped_column(BigInteger, nullable=False)
+    total: Mapped[float] = mapped_column(Float, nullable=False)
+
+
+class VpnCredentials(Base):
+    """Pre-generated VPN key pairs, see `quirck.box.stock`."""
+
+    __tablename__ = "vpn_credentials"
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    ca_key: Mapped[str] = mapped_column(Text, nullable=False)
+    ca_certificate: Mapped[str] = mapped_column(Text, nullable=False)
+    client_key: Mapped[str] = mapped_column(Text, nullable=False)
+    client_certificate: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=text("now()")
+    )
+
+    def bundle(self) -> dict[str, str]:
+        return {
+            "ca_key": self.ca_key,
+            "ca_certificate": self.ca_certificate,
+            "client_key": self.client_key,
+            "client_certificate": self.client_certificate,
+        }
+
+
 User.docker_meta = relationship("DockerMeta", back_populates="user", uselist=False)
 
 
-__all__ = ["DockerState", "DockerMeta", "DockerClientStats"]
+__all__ = [
+    "AdmissionState",
+    "DockerAdmission",
+    "DockerState",
+    "DockerMeta",
+    "DockerClientStats",
+    "DockerClientStatsHourly",
+    "DockerEvent",
+    "DockerImage",
+    "DockerJob",
+    "JobKind",
+    "JobState",
+    "DockerPoolSlot",
+    "DockerTiming",
+    "DockerTimingBucket",
+    "VpnCredentials",
+]
@@ -0,0 +1,166 @@
+"""Client of OpenVPN management interface exposed by relay containers."""
+
+import asyncio
+import time
+
+from quirck.box.client import get_docker
+
+MANAGEMENT_PORT = 7505
+
+# Relays accept connections at once, unless the interface is missing or unreachable
+CONNECT_TIMEOUT = 2
+
+# Seconds before a relay whose interface has failed is connected to again
+RETRY_INTERVAL = 600
+
+
+class ManagementError(RuntimeError): ...
+
+
+class ManagementConnection:
+    """Single connection to the management interface. Commands are serialized."""
+
+    reader: asyncio.StreamReader | None
+    writer: asyncio.StreamWriter | None
+
+    def __init__(self, host: str, port: int, password: str, timeout: float = 10):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def is_connected(self) -> bool:
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def connect(self) -> None:
+        try:
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port),
+                min(self.timeout, CONNECT_TIMEOUT),
+            )
+        except asyncio.TimeoutError as exc:
+            raise ManagementError("Connection timed out") from exc
+
+        prompt = await self._read_until(b":")
+        if not prompt.endswith(b"PASSWORD:"):
+            raise ManagementError(f"Unexpected greeting: {prompt!r}")
+
+        self.writer.write(self.password.encode() + b"\n")
+
+        while True:
+            line = await self._read_line()
+            if line.startswith("SUCCESS:"):
+                break
+            if line.startswith("ERROR:"):
+                raise ManagementError(f"Authentication failed: {line}")
+
+    async def command(self, command: str) -> str:
+        """Sends a command with multiline response terminated by END."""
+        async with self.lock:
+            if not self.is_connected:
+                await self.connect()
+
+            assert self.writer is not None
+            self.writer.write(command.encode() + b"\n")
+
+            lines: list[str] = []
+            while True:
+                line = await self._read_line()
+                if line == "END":
+                    return "\n".join(lines)
+                if line.startswith("ERROR:"):
+                    raise ManagementError(line)
+                # Real-time notifications may interleave with the response
+                if not line.startswith(">"):
+                    lines.append(line)
+
+    async def status(self) -> str:
+        return await self.command("status")
+
+    async def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+    async def _read_line(self) -> str:
+        line = await self._read_until(b"\n")
+        return line.decode(errors="replace").rstrip("\r\n")
+
+    async def _read_until(self, separator: bytes) -> bytes:
+        assert self.reader is not None
+        try:
+            return await asyncio.wait_for(
+                self.reader.readuntil(separator), self.timeout
+            )
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError) as exc:
+            await self.close()
+            raise ManagementError("Connection lost") from exc
+
+
+class ManagementCollector:
+    """Keeps persistent management connections to relay containers by their name.
+    Relays whose interface has failed are not connected to for `RETRY_INTERVAL`
+    seconds, `status` raises `ManagementError` for them right away."""
+
+    connections: dict[str, ManagementConnection]
+    # Container name to monotonic time of the next attempt
+    unavailable: dict[str, float]
+
+    def __init__(self, timeout: float = 10):
+        self.timeout = timeout
+        self.connections = {}
+        self.unavailable = {}
+
+    async def status(
+        self, container_name: str, password: str, node: str | None = None
+    ) -> str:
+        if self.unavailable.get(container_name, 0) > time.monotonic():
+            raise ManagementError("Management interface is not available")
+
+        connection = self.connections.get(container_name)
+
+        if connection is None or connection.password != password:
+            if connection is not None:
+                await connection.close()
+
+            container = await get_docker(node).containers.get(container_name)
+            host = container["NetworkSettings"]["Networks"]["bridge"]["IPAddress"]
+
+            connection = ManagementConnection(
+                host, MANAGEMENT_PORT, password, self.timeout
+            )
+            self.connections[container_name] = connection
+
+        try:
+            status = await connection.status()
+        except (OSError, ManagementError):
+            # Container may have been recreated with another address
+            self.connections.pop(container_name, None)
+            self.unavailable[container_name] = time.monotonic() + RETRY_INTERVAL
+            await connection.close()
+            raise
+
+        self.unavailable.pop(container_name, None)
+        return status
+
+    async def forget(self, keep: set[str]) -> None:
+        """Closes connections to containers not in `keep`."""
+        for name in set(self.connections) - keep:
+            await self.connections.pop(name).close()
+
+        for name in set(self.unavailable) - keep:
+            del self.unavailable[name]
+
+    async def close(self) -> None:
+        await self.forget(set())
+
+
+__all__ = ["ManagementCollector", "ManagementConnection", "ManagementError"]
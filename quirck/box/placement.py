@@ -0,0 +1,110 @@
+"""
+Placement of new deployments onto Docker nodes.
+
+The least loaded reachable node is chosen: the one with the smallest share of its
+memory reserved by running deployments (memory limits of admitted launches, see
+`quirck.box.admission`, and of warm pool slots) after placing the new one, then with fewer running
+containers. Nodes that do not respond in time are skipped.
+"""
+
+import asyncio
+import logging
+
+from attr import dataclass
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from quirck.box.client import NODES, get_docker, get_node
+from quirck.box.model import AdmissionState, DockerAdmission, DockerMeta, DockerPoolSlot
+
+logger = logging.getLogger(__name__)
+
+INFO_TIMEOUT = 5
+
+
+class NoNodeAvailable(RuntimeError): ...
+
+
+@dataclass
+class NodeLoad:
+    name: str
+    memory_total: int
+    memory_reserved: int
+    containers: int
+
+
+async def reserved_memory(session: AsyncSession) -> dict[str, int]:
+    default = get_node().name
+    node = func.coalesce(DockerMeta.node, default)
+
+    admitted = await session.execute(
+        select(node, func.sum(DockerAdmission.memory))
+        .join(DockerMeta, DockerMeta.user_id == DockerAdmission.user_id)
+        .where(DockerAdmission.state != AdmissionState.QUEUED)
+        .group_by(node)
+    )
+
+    slot_node = func.coalesce(DockerPoolSlot.node, default)
+    pooled = await session.execute(
+        select(slot_node, func.sum(DockerPoolSlot.memory))
+        .where(DockerPoolSlot.memory.is_not(None))
+        .group_by(slot_node)
+    )
+
+    reserved: dict[str, int] = {}
+    for name, memory in [*admitted.tuples(), *pooled.tuples()]:
+        reserved[name] = reserved.get(name, 0) + int(memory)
+
+    return reserved
+
+
+async def get_loads(session: AsyncSession) -> list[NodeLoad]:
+    reserved = await reserved_memory(session)
+
+    async def load(name: str) -> NodeLoad | None:
+        try:
+            info = await asyncio.wait_for(get_docker(name).system.info(), INFO_TIMEOUT)
+        except Exception:
+            logger.warning("Docker node %s is not available", name, exc_info=True)
+            return None
+
+        return NodeLoad(
+            name=name,
+            memory_total=info["MemTotal"],
+            memory_reserved=reserved.get(name, 0),
+            containers=info["ContainersRunning"],
+        )
+
+    loads = await asyncio.gather(*(load(name) for name in NODES))
+    return [load for load in loads if load is not None]
+
+
+async def choose_node(session: AsyncSession, memory: int) -> str:
+    """Returns name of the node to launch a deployment of `memory` bytes on."""
+    if len(NODES) == 1:
+        return get_node().name
+
+    loads = await get_loads(session)
+    if not loads:
+        raise NoNodeAvailable("No Docker node is available")
+
+    best = min(
+        loads,
+        key=lambda load: (
+            (load.memory_reserved + memory) / load.memory_total,
+            load.containers,
+        ),
+    )
+
+    logger.info(
+        "Placing deployment on %s: %d of %d MiB reserved, %d containers",
+        best.name,
+        best.memory_reserved // 2**20,
+        best.memory_total // 2**20,
+        best.containers,
+    )
+
+    return best.name
+
+
+__all__ = ["NoNodeAvailable", "choose_node"]
@@ -0,0 +1,276 @@
+"""
+Warm pool of deployments launched ahead of time.
+
+A pool keeps `size` deployments of a chapter created and started, but not yet
+assigned to anyone. `launch` claims one of them and only creates VPN containers
+on top of it, as they carry user-specific certificates and port binding. Pooled
+containers are not personalized (there is no `USER_ID` in their environment),
+so chapters relying on per-user container settings must not be pooled.
+
+Pools are declared by the app module as `warm_pools` and passed to `launch`.
+They are refilled in background after each claim and may be filled or drained
+manually. Slots reserve memory of pooled containers for admission and placement,
+so pools are not filled beyond `ADMISSION_MEMORY_MB`:
+
+    python -m quirck.box.pool [--chapter CHAPTER] [--drain]
+"""
+
+import argparse
+import asyncio
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.admission import deployment_memory, hand_over, used_memory
+from quirck.box.client import close_docker
+from quirck.box.config import ADMISSION_MEMORY_MB, WARM_POOL_SIZE
+from quirck.box.docker import Owner, deploy, remove_objects
+from quirck.box.images import pin_images
+from quirck.box.meta import Deployment
+from quirck.box.model import DockerMeta, DockerPoolSlot, DockerState
+from quirck.box.placement import choose_node
+from quirck.box.timing import detach
+from quirck.core.config import DATABASE_URL
+from quirck.db.engine import get_engine
+
+logger = logging.getLogger(__name__)
+
+# Slots stuck in progress for longer than that are considered abandoned
+STALE_SLOT_AGE = timedelta(minutes=15)
+
+# Keeps references to background refills, so they are not garbage collected
+_refills: set[asyncio.Task] = set()
+
+
+@dataclass(frozen=True)
+class WarmPool:
+    chapter: str
+    deployment: Deployment
+    size: int = WARM_POOL_SIZE
+
+    @property
+    def pooled(self) -> Deployment:
+        """Part of the deployment launched ahead of time: everything but VPN."""
+        return Deployment(
+            containers=[c for c in self.deployment.containers if not c.vpn],
+            networks=self.deployment.networks,
+        )
+
+    async def claim(
+        self, session: AsyncSession, meta: DockerMeta, deployment: Deployment
+    ) -> bool:
+        """Assigns a ready deployment to the user and creates VPN containers of
+        `deployment` on its networks. Returns False if the pool is empty."""
+        slot = (
+            await session.scalars(
+                select(DockerPoolSlot)
+                .where(
+                    DockerPoolSlot.chapter == self.chapter,
+                    DockerPoolSlot.state == DockerState.READY,
+                    DockerPoolSlot.user_id.is_(None),
+                )
+                .order_by(DockerPoolSlot.id)
+                .limit(1)
+                .with_for_update(skip_locked=True)
+            )
+        ).one_or_none()
+
+        if slot is None:
+            logger.info("Warm pool for %s is empty", self.chapter)
+            self.schedule_refill(session)
+            return False
+
+        slot.user_id = meta.user_id
+        slot.changed_at = datetime.now(timezone.utc)
+        meta.node = slot.node
+        await hand_over(session, meta.user_id, slot.memory or 0)
+        await session.commit()
+
+        logger.info("User %d claimed pooled slot %d", meta.user_id, slot.id)
+        self.schedule_refill(session)
+
+        await deploy(
+            Deployment(
+                containers=[c for c in deployment.containers if c.vpn], networks=[]
+            ),
+            Owner.user(meta),
+            meta,
+            network_owner=Owner.pool_slot(slot),
+        )
+
+        return True
+
+    def schedule_refill(self, session: AsyncSession) -> None:
+        factory = async_sessionmaker(session.bind, expire_on_commit=False)
+
+        task = asyncio.ensure_future(self.refill(factory))
+        _refills.add(task)
+        task.add_done_callback(_refills.discard)
+
+    async def refill(self, factory: async_sessionmaker[AsyncSession]) -> None:
+        """Launches deployments until the pool has `size` of them."""
+        # Refills may be scheduled by launches, but are not a part of them
+        detach()
+
+        async with factory() as session:
+            await self._lock(session)
+
+            stale = (
+                await session.scalars(
+                    select(DockerPoolSlot).where(
+                        DockerPoolSlot.chapter == self.chapter,
+                        DockerPoolSlot.state == DockerState.IN_PROGRESS,
+                        DockerPoolSlot.user_id.is_(None),
+                        DockerPoolSlot.changed_at
+                        < datetime.now(timezone.utc) - STALE_SLOT_AGE,
+                    )
+                )
+            ).all()
+
+            for slot in stale:
+                logger.warning("Removing abandoned pooled slot %d", slot.id)
+                await remove_objects(f"pool_slot={slot.id}", slot.node)
+                await session.delete(slot)
+
+            available = await session.scalar(
+                select(func.count(DockerPoolSlot.id)).where(
+                    DockerPoolSlot.chapter == self.chapter,
+                    DockerPoolSlot.user_id.is_(None),
+                )
+            )
+
+            memory = deployment_memory(self.pooled)
+            missing = self.size - (available or 0)
+
+            if ADMISSION_MEMORY_MB > 0 and memory > 0:
+                free = ADMISSION_MEMORY_MB * 1024 * 1024 - await used_memory(session)
+                if free < missing * memory:
+                    logger.warning(
+                        "Not enough memory to fill warm pool for %s", self.chapter
+                    )
+                    missing = min(missing, max(free // memory, 0))
+
+            slots: list[DockerPoolSlot] = []
+            for _ in range(missing):
+                # Added one by one, so that placement accounts for previous slots
+                slot = DockerPoolSlot(
+                    chapter=self.chapter,
+                    state=DockerState.IN_PROGRESS,
+                    node=await choose_node(session, memory),
+                    memory=memory,
+                )
+                session.add(slot)
+                slots.append(slot)
+            await session.commit()
+
+            pooled = await pin_images(session, self.pooled)
+
+        if slots:
+            logger.info("Filling warm pool for %s: %d slots", self.chapter, len(slots))
+
+        await asyncio.gather(*(self._fill(factory, slot, pooled) for slot in slots))
+
+    async def _fill(
+        self,
+        factory: async_sessionmaker[AsyncSession],
+        slot: DockerPoolSlot,
+        pooled: Deployment,
+    ) -> None:
+        try:
+            await deploy(pooled, Owner.pool_slot(slot))
+        except Exception:
+            logger.exception("Failed to launch pooled slot %d", slot.id)
+
+            await remove_objects(f"pool_slot={slot.id}", slot.node)
+            async with factory() as session:
+                await session.execute(
+                    delete(DockerPoolSlot).where(DockerPoolSlot.id == slot.id)
+                )
+                await session.commit()
+            return
+
+        async with factory() as session:
+            await session.execute(
+                update(DockerPoolSlot)
+                .where(DockerPoolSlot.id == slot.id)
+                .values(state=DockerState.READY, changed_at=datetime.now(timezone.utc))
+            )
+            await session.commit()
+
+    async def drain(self, factory: async_sessionmaker[AsyncSession]) -> None:
+        """Removes all unclaimed deployments, e.g. after the chapter has changed."""
+        async with factory() as session:
+            await self._lock(session)
+
+            slots = (
+                await session.scalars(
+                    select(DockerPoolSlot).where(
+                        DockerPoolSlot.chapter == self.chapter,
+                        DockerPoolSlot.user_id.is_(None),
+                    )
+                )
+            ).all()
+
+            for slot in slots:
+                await remove_objects(f"pool_slot={slot.id}", slot.node)
+                await session.delete(slot)
+
+            await session.commit()
+
+        logger.info("Drained %d slots of %s", len(slots), self.chapter)
+
+    async def _lock(self, session: AsyncSession) -> None:
+        # Serializes refills of the same chapter across workers and hosts
+        await session.execute(
+            select(func.pg_advisory_xact_lock(func.hashtext(f"pool:{self.chapter}")))
+        )
+
+
+async def main():
+    from quirck.core.module import app
+
+    parser = argparse.ArgumentParser(description="Fill or drain warm pools")
+    parser.add_argument("--chapter", type=str, help="Only process pool of this chapter")
+    parser.add_argument(
+        "--drain",
+        action="store_true",
+        help="Remove unclaimed deployments instead of filling pools",
+    )
+
+    args = parser.parse_args()
+
+    pools: list[WarmPool] = [
+        pool
+        for pool in getattr(app, "warm_pools", [])
+        if args.chapter is None or pool.chapter == args.chapter
+    ]
+
+    if not pools:
+        logger.info("No warm pools to process")
+        return
+
+    engine = get_engine(DATABASE_URL)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        for pool in pools:
+            if args.drain:
+                await pool.drain(factory)
+            else:
+                await pool.refill(factory)
+    finally:
+        await close_docker()
+        await engine.dispose()
+
+
+__all__ = ["WarmPool"]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s"
+    )
+    asyncio.run(main())
@@ -30,6 +30,13 @@ for network in $NETWORK_LIST; do
     ip link set br-$network promisc on
 done
 
+if [[ -n "$MANAGEMENT_PASSWORD" ]]; then
+    echo "$MANAGEMENT_PASSWORD" > /run/management.pw
+    chmod 600 /run/management.pw
+    grep -q '^management ' /app/openvpn.conf || \
+        echo "management 0.0.0.0 7505 /run/management.pw" >> /app/openvpn.conf
+fi
+
 openvpn --config /app/openvpn.conf --daemon
 
 shutdown() {
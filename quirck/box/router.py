@@ -0,0 +1,108 @@
+import secrets
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+)
+from starlette.routing import Mount, Route, Router
+
+from quirck.auth.middleware import AuthenticationMiddleware
+from quirck.auth.model import User
+from quirck.box.model import DockerJob, DockerMeta
+from quirck.box.timing import phase_histogram
+from quirck.box.vpn import PLATFORM_DIRECTIVES, render_client_config
+from quirck.core import config, metrics, s3
+
+
+async def vpn_config(request: Request) -> Response:
+    platform = request.path_params["platform"]
+    if platform not in PLATFORM_DIRECTIVES:
+        raise HTTPException(404, "Неизвестная платформа")
+
+    user: User = request.scope["user"]
+    session: AsyncSession = request.scope["db"]
+
+    meta = await session.scalar(select(DockerMeta).where(DockerMeta.user_id == user.id))
+    if meta is None or meta.vpn is None:
+        raise HTTPException(404, "Конфигурация VPN появится после первого запуска")
+
+    content = render_client_config(meta, platform)
+    if content is None:
+        return RedirectResponse(
+            await s3.get_url(
+                s3.S3_DEFAULT_BUCKET, "vpn", user.id, f"config-{platform}.ovpn"
+            ),
+            status_code=303,
+        )
+
+    return Response(
+        content,
+        media_type="application/x-openvpn-profile",
+        headers={
+            "Content-Disposition": f'attachment; filename="{config.APP_MODULE}-{platform}.ovpn"'
+        },
+    )
+
+
+async def job_status(request: Request) -> Response:
+    user: User = request.scope["user"]
+    session: AsyncSession = request.scope["db"]
+
+    job = await session.get(DockerJob, request.path_params["job_id"])
+    if job is None or job.user_id != user.id:
+        raise HTTPException(404, "Задача не найдена")
+
+    return JSONResponse(
+        {
+            "id": job.id,
+            "kind": job.kind.name.lower(),
+            "state": job.state.name.lower(),
+            "phase": job.phase,
+            "position": job.position,
+        }
+    )
+
+
+async def metrics_text(request: Request) -> Response:
+    """Histograms of the serving process, and of launches and stops of all of them."""
+    token = str(config.METRICS_TOKEN)
+    if token and not secrets.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {token}"
+    ):
+        raise HTTPException(403, "Доступ запрещён")
+
+    session: AsyncSession = request.scope["db"]
+
+    return PlainTextResponse(
+        metrics.render([await phase_histogram(session)]),
+        media_type="text/plain; version=0.0.4",
+    )
+
+
+box_router = Router(
+    [
+        Route("/metrics", metrics_text, name="metrics"),
+        Route(
+            "/job/{job_id:int}",
+            job_status,
+            middleware=[Middleware(AuthenticationMiddleware)],
+            name="job",
+        ),
+        Mount(
+            "/vpn",
+            routes=[Route("/config-{platform}.ovpn", vpn_config, name="config")],
+            middleware=[Middleware(AuthenticationMiddleware)],
+            name="vpn",
+        ),
+    ]
+)
+
+
+__all__ = ["box_router"]
@@ -0,0 +1,326 @@
+"""
+Storage of VPN client statistics.
+
+Raw samples go to `docker_client_stats`, which is partitioned by day, so that
+retention drops whole partitions instead of deleting rows. Partitions are
+created on demand before samples are inserted. Every cleanup pass also rolls
+recent samples up into `docker_client_stats_hourly`, which is what long-term
+queries should read.
+
+Counters of idle clients do not change between passes, so `ChangeRecorder`
+stores only samples that differ from the previous one, plus a heartbeat.
+
+`docker_client_stats` created before partitioning is not migrated automatically,
+tables are not created until it is renamed:
+
+    ALTER TABLE docker_client_stats RENAME TO docker_client_stats_old;
+    ALTER INDEX docker_client_stats_pkey RENAME TO docker_client_stats_old_pkey;
+    ALTER INDEX docker_client_stats_client RENAME TO docker_client_stats_old_client;
+    ALTER INDEX docker_client_stats_recorded_at
+        RENAME TO docker_client_stats_old_recorded_at;
+    ALTER SEQUENCE docker_client_stats_id_seq RENAME TO docker_client_stats_old_id_seq;
+
+Old samples may then be dropped, or copied once partitions of their days exist,
+see `ensure_partitions`.
+"""
+
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+
+from attr import dataclass
+from sqlalchemy import delete, func, literal_column, select, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession
+
+from quirck.box.config import (
+    CLIENT_STATS_HEARTBEAT,
+    CLIENT_STATS_RETENTION_DAYS,
+    CLIENT_STATS_ROLLUP_RETENTION_DAYS,
+)
+from quirck.box.model import DockerClientStats, DockerClientStatsHourly, DockerMeta
+
+logger = logging.getLogger(__name__)
+
+PARTITION_PREFIX = f"{DockerClientStats.__tablename__}_"
+
+# Days whose partitions are known to exist, to avoid DDL on every insert
+_partitions: set[date] = set()
+
+
+@dataclass
+class ClientStatPoint:
+    client_ip: str
+    connected_at: datetime
+    bytes_recv: int
+    bytes_sent: int
+    recorded_at: datetime
+
+
+# (docker_id, client_ip, connected_at) identify a single client connection
+SampleKey = tuple[int, str, datetime]
+
+
+class ChangeRecorder:
+    """
+    Remembers the last sample of every client connection and passes through only
+    samples which should be stored:
+     - the first sample of a connection
+     - samples with counters changed since the previous observed sample; if that
+     one was skipped, it is stored too, so that traffic rate between consecutive
+     stored samples stays the same as without skipping
+     - samples with unchanged counters, if the last stored one is `heartbeat` old
+
+    State is seeded from the database on the first use, so that a recorder in a
+    new process does not store everything again. Skipped samples are kept only in
+    memory and are lost when the process exits, then traffic since the last stored
+    sample is spread over the whole gap. Short-lived processes, e.g. cleanup run by
+    cron, should store every sample instead.
+    """
+
+    written: dict[SampleKey, ClientStatPoint]
+    skipped: dict[SampleKey, tuple[DockerMeta, ClientStatPoint]]
+
+    def __init__(
+        self, heartbeat: timedelta = timedelta(seconds=CLIENT_STATS_HEARTBEAT)
+    ):
+        self.heartbeat = heartbeat
+        self.written = {}
+        self.skipped = {}
+        self.seeded = False
+
+    async def seed(self, session: AsyncSession) -> None:
+        result = await session.execute(
+            select(DockerClientStats)
+            .where(
+                DockerClientStats.recorded_at
+                >= datetime.now(timezone.utc) - self.heartbeat
+            )
+            .distinct(
+                DockerClientStats.docker_id,
+                DockerClientStats.client_ip,
+                DockerClientStats.connected_at,
+            )
+            .order_by(
+                DockerClientStats.docker_id,
+                DockerClientStats.client_ip,
+                DockerClientStats.connected_at,
+                DockerClientStats.recorded_at.desc(),
+            )
+        )
+
+        for stats in result.scalars():
+            self.written[(stats.docker_id, stats.client_ip, stats.connected_at)] = (
+                ClientStatPoint(
+                    client_ip=stats.client_ip,
+                    connected_at=stats.connected_at,
+                    bytes_recv=stats.bytes_recv,
+                    bytes_sent=stats.bytes_sent,
+                    recorded_at=stats.recorded_at,
+                )
+            )
+
+        self.seeded = True
+
+    async def select(
+        self, session: AsyncSession, points: list[tuple[DockerMeta, ClientStatPoint]]
+    ) -> list[tuple[DockerMeta, ClientStatPoint]]:
+        """Returns points to store. `points` must contain all clients of a pass,
+        connections absent from it are forgotten."""
+        if not self.seeded:
+            await self.seed(session)
+
+        selected: list[tuple[DockerMeta, ClientStatPoint]] = []
+        seen: set[SampleKey] = set()
+
+        for docker, point in points:
+            key = (docker.port, point.client_ip, point.connected_at)
+            seen.add(key)
+
+            written = self.written.get(key)
+            skipped = self.skipped.pop(key, None)
+            previous = skipped[1] if skipped is not None else written
+
+            if (
+                written is None
+                or previous is None
+                or (point.bytes_recv, point.bytes_sent)
+                != (previous.bytes_recv, previous.bytes_sent)
+            ):
+                if skipped is not None:
+                    selected.append(skipped)
+            elif point.recorded_at - written.recorded_at < self.heartbeat:
+                self.skipped[key] = (docker, point)
+                continue
+
+            selected.append((docker, point))
+            self.written[key] = point
+
+        for key in set(self.written) - seen:
+            del self.written[key]
+        for key in set(self.skipped) - seen:
+            del self.skipped[key]
+
+        return selected
+
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def _day_start(day: date) -> datetime:
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+async def ensure_partitions(engine: AsyncEngine, days: set[date]) -> None:
+    """Creates partitions for given days (in UTC) if they do not exist. They are
+    committed at once, independently of the transaction inserting samples."""
+    missing = sorted(days - _partitions)
+    if not missing:
+        return
+
+    async with engine.begin() as conn:
+        for day in missing:
+            await conn.execute(
+                text(
+                    f'CREATE TABLE IF NOT EXISTS "{partition_name(day)}" '
+                    f'PARTITION OF "{DockerClientStats.__tablename__}" '
+                    f"FOR VALUES FROM ('{_day_start(day).isoformat()}') "
+                    f"TO ('{_day_start(day + timedelta(days=1)).isoformat()}')"
+                )
+            )
+
+    _partitions.update(missing)
+
+
+async def list_partitions(session: AsyncSession) -> dict[date, str]:
+    result = await session.scalars(
+        text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = :parent"
+        ),
+        {"parent": DockerClientStats.__tablename__},
+    )
+
+    partitions: dict[date, str] = {}
+    for name in result:
+        try:
+            day = datetime.strptime(name.removeprefix(PARTITION_PREFIX), "%Y%m%d")
+        except ValueError:
+            continue
+        partitions[day.date()] = name
+
+    return partitions
+
+
+async def drop_expired_partitions(
+    session: AsyncSession, retention_days: int = CLIENT_STATS_RETENTION_DAYS
+) -> list[str]:
+    """Drops partitions with samples older than `retention_days`. Returns their names."""
+    cutoff = datetime.now(timezone.utc).date() - timedelta(days=retention_days)
+    dropped: list[str] = []
+
+    for day, name in sorted((await list_partitions(session)).items()):
+        if day >= cutoff:
+            continue
+
+        await session.execute(text(f'DROP TABLE IF EXISTS "{name}"'))
+        _partitions.discard(day)
+        dropped.append(name)
+
+    return dropped
+
+
+async def rollup_client_stats(
+    session: AsyncSession, retention_days: int = CLIENT_STATS_RETENTION_DAYS
+) -> None:
+    """
+    Recomputes hourly aggregates since the last rolled up hour, including the
+    current one, so that hours missed while cleanup was not running are caught up
+    with, as long as their samples are kept for `retention_days`. The previous hour
+    is always included, so that it is finalized after it ends.
+    """
+    now = datetime.now(timezone.utc)
+    previous_hour = now.replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+    cutoff = now - timedelta(days=retention_days)
+
+    last_hour = await session.scalar(select(func.max(DockerClientStatsHourly.hour)))
+    since = max(min(last_hour or cutoff, previous_hour), cutoff)
+
+    # A literal, as bound parameters would make GROUP BY differ from the select list
+    hour = func.date_trunc(literal_column("'hour'"), DockerClientStats.recorded_at)
+    total = DockerClientStats.bytes_recv + DockerClientStats.bytes_sent
+
+    aggregates = (
+        select(
+            DockerClientStats.docker_id,
+            DockerClientStats.client_ip,
+            DockerClientStats.connected_at,
+            hour,
+            func.count(),
+            func.min(DockerClientStats.recorded_at),
+            func.max(DockerClientStats.recorded_at),
+            func.max(DockerClientStats.bytes_recv),
+            func.max(DockerClientStats.bytes_sent),
+            func.max(total) - func.min(total),
+        )
+        .where(DockerClientStats.recorded_at >= since)
+        .group_by(
+            DockerClientStats.docker_id,
+            DockerClientStats.client_ip,
+            DockerClientStats.connected_at,
+            hour,
+        )
+    )
+
+    statement = insert(DockerClientStatsHourly).from_select(
+        [
+            "docker_id",
+            "client_ip",
+            "connected_at",
+            "hour",
+            "samples",
+            "first_recorded_at",
+            "last_recorded_at",
+            "bytes_recv",
+            "bytes_sent",
+            "traffic",
+        ],
+        aggregates,
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=["docker_id", "client_ip", "connected_at", "hour"],
+        set_={
+            column: statement.excluded[column]
+            for column in (
+                "samples",
+                "first_recorded_at",
+                "last_recorded_at",
+                "bytes_recv",
+                "bytes_sent",
+                "traffic",
+            )
+        },
+    )
+
+    await session.execute(statement)
+
+
+async def delete_expired_rollups(
+    session: AsyncSession, retention_days: int = CLIENT_STATS_ROLLUP_RETENTION_DAYS
+) -> None:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=retention_days)
+    await session.execute(
+        delete(DockerClientStatsHourly).where(DockerClientStatsHourly.hour < cutoff)
+    )
+
+
+__all__ = [
+    "ChangeRecorder",
+    "ClientStatPoint",
+    "ensure_partitions",
+    "drop_expired_partitions",
+    "rollup_client_stats",
+    "delete_expired_rollups",
+]
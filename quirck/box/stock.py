@@ -0,0 +1,99 @@
+"""
+Producer of pre-generated VPN credentials.
+
+Keeps the `vpn_credentials` table filled with ready key pairs, so that first-time
+launches do not spend time on cryptography. Run it as a separate process, e.g.
+with its own CPU quota:
+
+    python -m quirck.box.stock [--size 100] [--daemon --interval 60]
+"""
+
+import argparse
+import asyncio
+import logging
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.config import VPN_CRYPTO_QUEUE, VPN_STOCK_SIZE
+from quirck.box.model import VpnCredentials
+from quirck.box.vpn import close_executor, generate_credentials, run_crypto
+from quirck.core import config
+from quirck.core.config import DATABASE_URL
+from quirck.db.engine import get_engine
+
+logger = logging.getLogger(__name__)
+
+
+async def fill_stock(factory: async_sessionmaker[AsyncSession], size: int) -> int:
+    """Generates credentials until there are `size` of them. Returns number of
+    generated bundles."""
+    async with factory() as session:
+        available = await session.scalar(select(func.count(VpnCredentials.id))) or 0
+
+    missing = max(size - available, 0)
+    generated = 0
+
+    while generated < missing:
+        batch = min(missing - generated, VPN_CRYPTO_QUEUE)
+        bundles = await asyncio.gather(
+            *(
+                run_crypto(generate_credentials, f"quirck-{config.APP_MODULE}")
+                for _ in range(batch)
+            )
+        )
+
+        async with factory() as session:
+            session.add_all(VpnCredentials(**bundle) for bundle in bundles)
+            await session.commit()
+
+        generated += batch
+
+    return generated
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Pre-generate VPN credentials")
+    parser.add_argument(
+        "--size",
+        type=int,
+        default=VPN_STOCK_SIZE,
+        help=f"Number of credentials to keep in stock (default: {VPN_STOCK_SIZE})",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep running and refill the stock periodically",
+    )
+    parser.add_argument(
+        "--interval",
+        type=int,
+        default=60,
+        help="Seconds between refills in daemon mode (default: 60)",
+    )
+
+    args = parser.parse_args()
+
+    engine = get_engine(DATABASE_URL)
+    factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        while True:
+            generated = await fill_stock(factory, args.size)
+            if generated:
+                logger.info("Generated %d VPN credentials", generated)
+
+            if not args.daemon:
+                break
+
+            await asyncio.sleep(args.interval)
+    finally:
+        close_executor()
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(name)s - %(levelname)s - %(message)s"
+    )
+    asyncio.run(main())
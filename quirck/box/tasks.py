@@ -0,0 +1,28 @@
+"""Helpers for running Docker operations concurrently."""
+
+import asyncio
+from typing import Awaitable, TypeVar
+
+T = TypeVar("T")
+
+
+async def bounded(semaphore: asyncio.Semaphore, awaitable: Awaitable[T]) -> T:
+    async with semaphore:
+        return await awaitable
+
+
+async def gather_cancelling(*awaitables: Awaitable[T]) -> list[T]:
+    """Like `asyncio.gather`, but the first failure cancels all other awaitables
+    and waits for them to finish before the exception is propagated."""
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+__all__ = ["bounded", "gather_cancelling"]
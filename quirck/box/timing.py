@@ -0,0 +1,281 @@
+"""
+Timing of launch and stop phases.
+
+`launch` and `stop_locked` are `timed` and wrap their phases into `measure`:
+sequential steps such as cleaning, admission or deploying, and Docker operations
+within them, which run concurrently. Phases of every launch and stop are stored
+in `docker_timing`, also by the image they were declared with, see `percentiles`
+for time-to-ready over a period.
+
+Launches and stops run in web and job workers alike, so instead of keeping
+measurements in memory of each process, `store` also adds them to bucket counters
+in `docker_timing_bucket`. `box:metrics` route exposes these as
+`quirck_box_phase_seconds` histogram, see `phase_histogram`.
+"""
+
+import functools
+import logging
+import math
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from itertools import accumulate
+from typing import Any, Awaitable, Callable, Iterator, TypeVar
+
+from sqlalchemy import func, inspect, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from quirck.box.exception import LaunchQueued
+from quirck.box.model import DockerMeta, DockerTiming, DockerTimingBucket
+from quirck.core.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+_current: ContextVar["Timing | None"] = ContextVar("timing", default=None)
+
+
+class Timing:
+    def __init__(self, operation: str, chapter: str | None):
+        self.operation = operation
+        self.chapter = chapter
+        self.phases: dict[str, float] = {}
+        self.image_phases: dict[str, dict[str, float]] = {}
+        # Pinned image ID to the name it was declared with, see `declare_images`
+        self.image_names: dict[str, str] = {}
+        self.started_at = datetime.now(timezone.utc)
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def activate(self) -> Iterator["Timing"]:
+        """Makes `measure` report to this timing, including in tasks started within."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def observe(self, phase: str, seconds: float, image: str = "") -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+        if image:
+            phases = self.image_phases.setdefault(
+                self.image_names.get(image, image), {}
+            )
+            phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def finish(self, user_id: int, node: str | None, outcome: str) -> DockerTiming:
+        total = time.perf_counter() - self._started
+
+        return DockerTiming(
+            user_id=user_id,
+            operation=self.operation,
+            chapter=self.chapter,
+            node=node,
+            outcome=outcome,
+            started_at=self.started_at,
+            total=total,
+            phases=_rounded(self.phases),
+            image_phases={
+                image: _rounded(phases) for image, phases in self.image_phases.items()
+            }
+            or None,
+        )
+
+
+def _rounded(phases: dict[str, float]) -> dict[str, float]:
+    return {phase: round(seconds, 3) for phase, seconds in phases.items()}
+
+
+def declare_images(names: dict[str, str]) -> None:
+    """Makes measurements of the current timing labelled with pinned image IDs
+    report names the images were declared with."""
+    timing = _current.get()
+    if timing is not None:
+        timing.image_names.update(names)
+
+
+def detach() -> None:
+    """Stops reporting measurements of the current task, e.g. a background one, to
+    the timing it has been started from."""
+    _current.set(None)
+
+
+@contextmanager
+def measure(phase: str, image: str = "") -> Iterator[None]:
+    """Measures a phase of the current launch or stop, if any."""
+    timing = _current.get()
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        if timing is not None:
+            timing.observe(phase, time.perf_counter() - started, image)
+
+
+async def measured(awaitable: Awaitable[T], phase: str, image: str = "") -> T:
+    with measure(phase, image):
+        return await awaitable
+
+
+def buckets(row: DockerTiming) -> list[dict[str, Any]]:
+    """Returns increments of histogram buckets by the timing, sorted by their keys,
+    so that concurrent updates lock rows in the same order."""
+    increments: dict[tuple[str, str, float], tuple[int, float]] = {}
+
+    def observe(phase: str, image: str, seconds: float) -> None:
+        index = bisect_left(PHASE_BUCKETS, seconds)
+        le = float(PHASE_BUCKETS[index]) if index < len(PHASE_BUCKETS) else math.inf
+        count, total = increments.get((phase, image, le), (0, 0.0))
+        increments[(phase, image, le)] = (count + 1, total + seconds)
+
+    observe("total", "", row.total)
+    for phase, seconds in row.phases.items():
+        observe(phase, "", seconds)
+    for image, phases in (row.image_phases or {}).items():
+        for phase, seconds in phases.items():
+            observe(phase, image, seconds)
+
+    return [
+        {
+            "operation": row.operation,
+            "phase": phase,
+            "chapter": row.chapter or "",
+            "image": image,
+            "le": le,
+            "count": count,
+            "total": total,
+        }
+        for (phase, image, le), (count, total) in sorted(increments.items())
+    ]
+
+
+async def store(session: AsyncSession, row: DockerTiming) -> None:
+    # The session of the operation may be in any state after a failure
+    try:
+        async with async_sessionmaker(session.bind)() as timing_session:
+            timing_session.add(row)
+
+            statement = insert(DockerTimingBucket).values(buckets(row))
+            statement = statement.on_conflict_do_update(
+                index_elements=["operation", "phase", "chapter", "image", "le"],
+                set_={
+                    "count": DockerTimingBucket.count + statement.excluded.count,
+                    "total": DockerTimingBucket.total + statement.excluded.total,
+                },
+            )
+            await timing_session.execute(statement)
+            await timing_session.commit()
+    except Exception:
+        logger.exception("Failed to store timing of user %d", row.user_id)
+
+
+def timed(operation: str, outcome: str) -> Callable:
+    """Runs `function(session, meta, ...)` in a `Timing`, which is stored with the
+    `outcome` on success, "queued" if the launch is queued, or "failed"."""
+
+    def decorator(function: Callable[..., Awaitable[None]]) -> Callable:
+        @functools.wraps(function)
+        async def wrapper(
+            session: AsyncSession, meta: DockerMeta, *args: Any, **kwargs: Any
+        ) -> None:
+            user_id = meta.user_id
+            timing = Timing(operation, meta.chapter)
+            result = "failed"
+
+            try:
+                with timing.activate():
+                    await function(session, meta, *args, **kwargs)
+                result = outcome
+            except LaunchQueued:
+                result = "queued"
+                raise
+            finally:
+                # Attributes are expired after a rollback and cannot be loaded here
+                node = inspect(meta).dict.get("node")
+                await store(session, timing.finish(user_id, node, result))
+
+        return wrapper
+
+    return decorator
+
+
+async def percentiles(
+    session: AsyncSession,
+    since: datetime,
+    until: datetime | None = None,
+    operation: str = "launch",
+) -> dict[str | None, tuple[int, float, float]]:
+    """Returns number, p50 and p99 of total time of successful operations by chapter."""
+    query = (
+        select(
+            DockerTiming.chapter,
+            func.count(),
+            func.percentile_cont(0.5).within_group(DockerTiming.total),
+            func.percentile_cont(0.99).within_group(DockerTiming.total),
+        )
+        .where(
+            DockerTiming.operation == operation,
+            DockerTiming.outcome.in_(("ready", "stopped")),
+            DockerTiming.started_at >= since,
+        )
+        .group_by(DockerTiming.chapter)
+    )
+    if until is not None:
+        query = query.where(DockerTiming.started_at < until)
+
+    return {
+        chapter: (count, p50, p99)
+        for chapter, count, p50, p99 in await session.execute(query)
+    }
+
+
+async def phase_histogram(session: AsyncSession) -> Histogram:
+    """Builds the histogram of phases of all stored launches and stops. Phases are
+    observed once per operation, with concurrent Docker operations summed up, and
+    also by image for operations on containers."""
+    histogram = Histogram(
+        "quirck_box_phase_seconds",
+        "Time spent in phases of launches and stops",
+        labels=("operation", "phase", "chapter", "image"),
+        buckets=PHASE_BUCKETS,
+        register=False,
+    )
+
+    # Counts and sums by bucket index, the last one is +Inf
+    series: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    for bucket in await session.scalars(select(DockerTimingBucket)):
+        counts, totals = series.setdefault(
+            (bucket.operation, bucket.phase, bucket.chapter, bucket.image),
+            ([0] * (len(PHASE_BUCKETS) + 1), [0.0] * (len(PHASE_BUCKETS) + 1)),
+        )
+        index = bisect_left(PHASE_BUCKETS, bucket.le)
+        counts[index] += bucket.count
+        totals[index] += bucket.total
+
+    for label_values, (counts, totals) in series.items():
+        histogram.load(
+            label_values, list(accumulate(counts[:-1])), sum(counts), sum(totals)
+        )
+
+    return histogram
+
+
+__all__ = [
+    "Timing",
+    "declare_images",
+    "detach",
+    "measure",
+    "measured",
+    "percentiles",
+    "phase_histogram",
+    "timed",
+]
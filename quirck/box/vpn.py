@@ -1,4 +1,10 @@
+import asyncio
+import functools
+import secrets
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, TypeVar
 
 from cryptography import x509
 from cryptography.x509.oid import NameOID
@@ -14,9 +20,28 @@ from cryptography.hazmat.primitives.serialization import (
     PrivateFormat,
     NoEncryption,
 )
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from quirck.box.client import get_node
+from quirck.box.config import (
+    VPN_CONFIG_CACHE_SIZE,
+    VPN_CRYPTO_EXECUTOR,
+    VPN_CRYPTO_QUEUE,
+    VPN_CRYPTO_WORKERS,
+)
+from quirck.box.model import DockerMeta, VpnCredentials
+from quirck.core import config
+from quirck.core.metrics import Histogram
 
-from quirck.box.config import VPN_HOST
-from quirck.core import config, s3
+T = TypeVar("T")
+
+crypto_queued = Histogram(
+    "quirck_vpn_crypto_queued_seconds", "Time VPN key generation waits for a worker"
+)
+crypto_running = Histogram(
+    "quirck_vpn_crypto_running_seconds", "Time VPN key generation takes in a worker"
+)
 
 
 BASE = """client
@@ -74,6 +99,8 @@ up "/usr/bin/env sh -c 'ip link set $dev up || ifconfig $dev up'"
 up-restart
 """
 
+PLATFORM_DIRECTIVES = {"win": "", "linux": LINUX_DIRECTIVES}
+
 
 def generate_key_pair(
     curve: ec.EllipticCurve,
@@ -126,18 +153,19 @@ def generate_key_pair(
     return private_key, certificate
 
 
-def format_pem_for_conf(pem: bytes) -> str:
-    return pem.decode().strip()
+def format_pem_for_conf(pem: str) -> str:
+    return pem.strip()
 
 
-def format_pem_for_env(pem: bytes) -> str:
+def format_pem_for_env(pem: str) -> str:
     """Removes header and footer and concatenates all in a single line."""
-    return "".join(pem.decode().strip().splitlines()[1:-1])
+    return "".join(pem.strip().splitlines()[1:-1])
 
 
-async def generate_vpn(user_id: int, port: int):
+def generate_credentials(prefix: str) -> dict[str, str]:
+    """Generates CA and client key pairs. Returns a bundle of PEM-encoded keys and
+    certificates. This is CPU-bound and is executed in a worker pool."""
     curve = ec.SECP256R1()
-    prefix = f"quirck-{config.APP_MODULE}-{user_id}"
 
     ca_key, ca_certificate = generate_key_pair(
         curve, f"{prefix}-server", signing_key=None, signing_issuer=None
@@ -150,41 +178,148 @@ async def generate_vpn(user_id: int, port: int):
         signing_key=ca_key,
     )
 
-    for platform, directives in [("win", ""), ("linux", LINUX_DIRECTIVES)]:
-        client_config = BASE.format(
-            host=VPN_HOST,
-            port=port,
-            directives=directives,
-            ca_certificate=format_pem_for_conf(
-                ca_certificate.public_bytes(Encoding.PEM)
-            ),
-            client_certificate=format_pem_for_conf(
-                client_certificate.public_bytes(Encoding.PEM)
-            ),
-            client_key=format_pem_for_conf(
-                client_key.private_bytes(
-                    Encoding.PEM,
-                    PrivateFormat.TraditionalOpenSSL,
-                    encryption_algorithm=NoEncryption(),
-                )
-            ),
+    def private_pem(key: ec.EllipticCurvePrivateKey) -> str:
+        return key.private_bytes(
+            Encoding.PEM,
+            PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=NoEncryption(),
+        ).decode()
+
+    return {
+        "ca_key": private_pem(ca_key),
+        "ca_certificate": ca_certificate.public_bytes(Encoding.PEM).decode(),
+        "client_key": private_pem(client_key),
+        "client_certificate": client_certificate.public_bytes(Encoding.PEM).decode(),
+    }
+
+
+def timed_call(func: Callable[..., T], *args: Any) -> tuple[float, T]:
+    """Runs in the pool. Wall clock is used as start may happen in another process."""
+    started_at = time.time()
+    return started_at, func(*args)
+
+
+_executor: Executor | None = None
+_queue = asyncio.Semaphore(VPN_CRYPTO_QUEUE)
+
+
+def get_executor() -> Executor:
+    global _executor
+
+    if _executor is None:
+        match VPN_CRYPTO_EXECUTOR:
+            case "thread":
+                _executor = ThreadPoolExecutor(VPN_CRYPTO_WORKERS, "vpn-crypto")
+            case "process":
+                _executor = ProcessPoolExecutor(VPN_CRYPTO_WORKERS)
+            case _:
+                raise ValueError(f"Unknown executor: {VPN_CRYPTO_EXECUTOR}")
+
+    return _executor
+
+
+def close_executor() -> None:
+    global _executor
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_crypto(func: Callable[..., T], *args: Any) -> T:
+    submitted_at = time.time()
+
+    async with _queue:
+        started_at, result = await asyncio.get_running_loop().run_in_executor(
+            get_executor(), timed_call, func, *args
+        )
+
+    crypto_queued.observe(max(started_at - submitted_at, 0))
+    crypto_running.observe(max(time.time() - started_at, 0))
+
+    return result
+
+
+async def take_credentials(session: AsyncSession) -> dict[str, str] | None:
+    """Takes a bundle from the stock. It is removed once the transaction commits."""
+    credentials = (
+        await session.scalars(
+            select(VpnCredentials)
+            .order_by(VpnCredentials.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
         )
+    ).one_or_none()
+
+    if credentials is None:
+        return None
+
+    await session.delete(credentials)
+    return credentials.bundle()
+
+
+@functools.lru_cache(maxsize=VPN_CONFIG_CACHE_SIZE)
+def render_config(
+    host: str,
+    port: int,
+    platform: str,
+    ca_certificate: str,
+    client_certificate: str,
+    client_key: str,
+) -> str:
+    return BASE.format(
+        host=host,
+        port=port,
+        directives=PLATFORM_DIRECTIVES[platform],
+        ca_certificate=format_pem_for_conf(ca_certificate),
+        client_certificate=format_pem_for_conf(client_certificate),
+        client_key=format_pem_for_conf(client_key),
+    )
+
+
+def render_client_config(meta: DockerMeta, platform: str) -> str | None:
+    """Returns None for instances configured before configs were rendered on demand:
+    their configs are in S3."""
+    if meta.vpn is None or "client" not in meta.vpn:
+        return None
+
+    client = meta.vpn["client"]
+
+    return render_config(
+        get_node(meta.node).vpn_host,
+        meta.port,
+        platform,
+        client["ca_certificate"],
+        client["client_certificate"],
+        client["client_key"],
+    )
+
+
+def get_vpn_environment(vpn: dict[str, Any]) -> dict[str, str]:
+    """Extracts environment of VPN container from `DockerMeta.vpn`."""
+    return {
+        key: vpn[key] for key in ("CERT", "KEY", "MANAGEMENT_PASSWORD") if key in vpn
+    }
+
+
+async def generate_vpn(user_id: int, session: AsyncSession | None = None):
+    """Uses pre-generated credentials if `session` is given and the stock is not
+    empty, otherwise generates new ones. Result is to be stored in `DockerMeta.vpn`.
+    """
+    bundle = await take_credentials(session) if session is not None else None
 
-        await s3.upload_bytes(
-            s3.S3_DEFAULT_BUCKET,
-            "vpn",
-            user_id,
-            f"config-{platform}.ovpn",
-            client_config.encode(),
+    if bundle is None:
+        bundle = await run_crypto(
+            generate_credentials, f"quirck-{config.APP_MODULE}-{user_id}"
         )
 
     return {
-        "CERT": format_pem_for_env(ca_certificate.public_bytes(Encoding.PEM)),
-        "KEY": format_pem_for_env(
-            ca_key.private_bytes(
-                Encoding.PEM,
-                PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=NoEncryption(),
-            )
-        ),
+        "CERT": format_pem_for_env(bundle["ca_certificate"]),
+        "KEY": format_pem_for_env(bundle["ca_key"]),
+        "MANAGEMENT_PASSWORD": secrets.token_urlsafe(24),
+        "client": {
+            "ca_certificate": bundle["ca_certificate"],
+            "client_certificate": bundle["client_certificate"],
+            "client_key": bundle["client_key"],
+        },
     }
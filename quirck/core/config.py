@@ -20,3 +20,6 @@ SSO_CLIENT_SECRET = config("SSO_CLIENT_SECRET", cast=Secret)
 ALLOWED_GROUPS = config("ALLOWED_GROUPS", cast=CommaSeparatedStrings)
 
 APP_MODULE = config("APP_MODULE", cast=str)
+
+# Bearer token required to read metrics, which are open if it is empty
+METRICS_TOKEN = config("METRICS_TOKEN", cast=Secret, default="")
@@ -0,0 +1,122 @@
+"""Minimal in-process metrics, modelled after Prometheus histograms."""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Sequence
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class HistogramSeries:
+    def __init__(self, buckets: Sequence[float]):
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram:
+    """Distribution of observed values, optionally split by label values."""
+
+    series: dict[tuple[str, ...], HistogramSeries]
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        register: bool = True,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+        if register:
+            registry.append(self)
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if len(label_values) != len(self.labels):
+            raise ValueError(f"{self.name} expects labels {self.labels}")
+
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = HistogramSeries(self.buckets)
+
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.count += 1
+        series.sum += value
+
+    def load(
+        self,
+        label_values: tuple[str, ...],
+        cumulative: Sequence[int],
+        count: int,
+        total: float,
+    ) -> None:
+        """Sets a series from counts of values up to each bucket, e.g. aggregated
+        by a database query."""
+        series = self.series[label_values] = HistogramSeries(self.buckets)
+        series.counts = [
+            upper - lower
+            for lower, upper in zip([0, *cumulative], [*cumulative, count], strict=True)
+        ]
+        series.count = count
+        series.sum = total
+
+    @contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *label_values)
+
+
+registry: list[Histogram] = []
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+
+    pairs = ",".join(
+        f'{name}="{escape(value)}"' for name, value in zip(names, values, strict=True)
+    )
+    return f"{{{pairs}}}"
+
+
+def render(histograms: Iterable[Histogram] = ()) -> str:
+    """Renders all histograms of the process, and the given ones, in Prometheus
+    text format."""
+    lines = []
+
+    for histogram in [*registry, *histograms]:
+        lines.append(f"# HELP {histogram.name} {histogram.documentation}")
+        lines.append(f"# TYPE {histogram.name} histogram")
+
+        for label_values, series in sorted(histogram.series.items()):
+            cumulative = 0
+            bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+
+            for bound, count in zip(bounds, series.counts, strict=True):
+                cumulative += count
+                labels = format_labels(
+                    histogram.labels + ("le",), label_values + (bound,)
+                )
+                lines.append(f"{histogram.name}_bucket{labels} {cumulative}")
+
+            labels = format_labels(histogram.labels, label_values)
+            lines.append(f"{histogram.name}_sum{labels} {series.sum}")
+            lines.append(f"{histogram.name}_count{labels} {series.count}")
+
+    return "\n".join(lines) + "\n"
+
+
+__all__ = ["Histogram", "registry", "render"]
@@ -1,18 +1,88 @@
+import asyncio
+import bisect
 import io
+import time
+from contextlib import AsyncExitStack
 from pathlib import Path
+from typing import Any, AsyncIterable, Generic, Iterable, TypeVar
 
 import aioboto3
 import botocore.client
+from boto3.s3.transfer import TransferConfig
 from starlette.datastructures import Secret
 
 from quirck.core.config import config
 
+K = TypeVar("K")
+V = TypeVar("V")
 
 S3_ENDPOINT_URL = config("S3_ENDPOINT_URL", cast=str)
 S3_REGION_NAME = config("S3_REGION_NAME", cast=str, default="us-east-1")
 S3_ACCESS_KEY_ID = config("S3_ACCESS_KEY_ID", cast=str)
 S3_SECRET_ACCESS_KEY = config("S3_SECRET_ACCESS_KEY", cast=Secret)
 S3_DEFAULT_BUCKET = config("S3_DEFAULT_BUCKET", cast=str)
+S3_POOL_SIZE = config("S3_POOL_SIZE", cast=int, default=32)
+S3_URL_CACHE_SIZE = config("S3_URL_CACHE_SIZE", cast=int, default=10000)
+S3_LIST_CACHE_SIZE = config("S3_LIST_CACHE_SIZE", cast=int, default=10000)
+# Size of parts and number of parts in flight for multipart uploads. S3 requires
+# parts (except the last one) to be at least 5 MiB.
+S3_PART_SIZE = config("S3_PART_SIZE", cast=int, default=8 * 1024 * 1024)
+S3_UPLOAD_CONCURRENCY = config("S3_UPLOAD_CONCURRENCY", cast=int, default=4)
+# Listings are kept up to date by uploads of this process, TTL catches others
+S3_LIST_CACHE_TTL = config("S3_LIST_CACHE_TTL", cast=float, default=30)
+
+# Presigned URLs are valid for URL_EXPIRES_IN seconds and are reused until less
+# than URL_MIN_TTL seconds are left
+URL_EXPIRES_IN = 3600
+URL_MIN_TTL = 600
+
+_client = None
+_client_stack: AsyncExitStack | None = None
+_client_lock = asyncio.Lock()
+
+
+class TTLCache(Generic[K, V]):
+    """Per-process mapping with expiring entries. When full, the oldest entry is
+    evicted."""
+
+    entries: dict[K, tuple[float, V]]
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = {}
+
+    def get(self, key: K) -> V | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+
+        return value
+
+    def set(self, key: K, value: V, ttl: float) -> None:
+        self.entries.pop(key, None)
+
+        while len(self.entries) >= self.max_size:
+            del self.entries[next(iter(self.entries))]
+
+        self.entries[key] = (time.monotonic() + ttl, value)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=S3_PART_SIZE,
+    multipart_chunksize=S3_PART_SIZE,
+    max_concurrency=S3_UPLOAD_CONCURRENCY,
+)
+
+url_cache: TTLCache[tuple[str, str, int, str], str] = TTLCache(S3_URL_CACHE_SIZE)
+list_cache: TTLCache[tuple[str, str, int], list[str]] = TTLCache(S3_LIST_CACHE_SIZE)
 
 
 def get_session() -> aioboto3.Session:
@@ -26,7 +96,11 @@ def get_client():
         "s3",
         S3_REGION_NAME,
         endpoint_url=S3_ENDPOINT_URL,
-        config=botocore.client.Config(signature_version="s3v4"),
+        config=botocore.client.Config(
+            signature_version="s3v4",
+            max_pool_connections=S3_POOL_SIZE,
+            tcp_keepalive=True,
+        ),
     )
 
 
@@ -34,28 +108,87 @@ def get_resource():
     return get_session().resource("s3", S3_REGION_NAME, endpoint_url=S3_ENDPOINT_URL)
 
 
+async def get_shared_client():
+    """Returns the client shared by all helpers of this process. It is created on
+    first use and closed by `close_shared_client` on shutdown."""
+    global _client, _client_stack
+
+    async with _client_lock:
+        if _client is None:
+            _client_stack = AsyncExitStack()
+            _client = await _client_stack.enter_async_context(get_client())
+
+    return _client
+
+
+async def close_shared_client() -> None:
+    global _client, _client_stack
+
+    async with _client_lock:
+        if _client_stack is not None:
+            await _client_stack.aclose()
+        _client = _client_stack = None
+
+
 async def list_files(bucket_name: str, folder: str, user_id: int) -> list[str]:
+    """Lists files of the folder. Listings are cached for `S3_LIST_CACHE_TTL`
+    seconds and updated by uploads made through this module."""
+    cached = list_cache.get((bucket_name, folder, user_id))
+    if cached is not None:
+        return list(cached)
+
     prefix = f"{folder}/{user_id}/"
 
-    async with get_resource() as s3:
-        bucket = await s3.Bucket(bucket_name)
+    s3_client = await get_shared_client()
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    files = [
+        item["Key"][len(prefix) :]
+        async for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for item in page.get("Contents", [])
+    ]
+    list_cache.set((bucket_name, folder, user_id), files, S3_LIST_CACHE_TTL)
+
+    return list(files)
+
 
-        return [
-            item.key[len(prefix) :]
-            async for item in bucket.objects.filter(Prefix=prefix)
-        ]
+def remember_upload(bucket_name: str, folder: str, user_id: int, filename: str) -> None:
+    files = list_cache.get((bucket_name, folder, user_id))
+
+    # S3 lists keys in lexicographical order
+    if files is not None and filename not in files:
+        bisect.insort(files, filename)
 
 
 async def get_url(bucket_name: str, folder: str, user_id: int, filename: str) -> str:
-    path = f"{folder}/{user_id}/{filename}"
+    return (await get_urls(bucket_name, folder, user_id, [filename]))[filename]
+
+
+async def get_urls(
+    bucket_name: str, folder: str, user_id: int, filenames: Iterable[str]
+) -> dict[str, str]:
+    """Returns presigned download URLs by file names. URLs are cached per process
+    while they remain valid for at least `URL_MIN_TTL` seconds."""
+    urls: dict[str, str] = {}
+    s3_client = None
+
+    for filename in filenames:
+        key = (bucket_name, folder, user_id, filename)
+
+        url = url_cache.get(key)
+        if url is None:
+            s3_client = s3_client or await get_shared_client()
+            url = await s3_client.generate_presigned_url(
+                ClientMethod="get_object",
+                HttpMethod="GET",
+                Params={"Bucket": bucket_name, "Key": f"{folder}/{user_id}/{filename}"},
+                ExpiresIn=URL_EXPIRES_IN,
+            )
+            url_cache.set(key, url, URL_EXPIRES_IN - URL_MIN_TTL)
+
+        urls[filename] = url
 
-    async with get_client() as s3_client:
-        return await s3_client.generate_presigned_url(
-            ClientMethod="get_object",
-            HttpMethod="GET",
-            Params={"Bucket": bucket_name, "Key": path},
-            ExpiresIn=3600,
-        )
+    return urls
 
 
 async def upload_file(
@@ -63,10 +196,9 @@ async def upload_file(
 ) -> str:
     path = f"{folder}/{user_id}/{filename}"
 
-    async with get_resource() as s3:
-        bucket = await s3.Bucket(bucket_name)
-
-        await bucket.upload_file(source, path)
+    s3_client = await get_shared_client()
+    await s3_client.upload_file(str(source), bucket_name, path, Config=TRANSFER_CONFIG)
+    remember_upload(bucket_name, folder, user_id, filename)
 
     return path
 
@@ -76,12 +208,104 @@ async def upload_bytes(
 ) -> str:
     path = f"{folder}/{user_id}/{filename}"
 
-    async with get_resource() as s3:
-        bucket = await s3.Bucket(bucket_name)
+    s3_client = await get_shared_client()
+    await s3_client.upload_fileobj(
+        io.BytesIO(content), bucket_name, path, Config=TRANSFER_CONFIG
+    )
+    remember_upload(bucket_name, folder, user_id, filename)
+
+    return path
+
+
+async def upload_stream(
+    bucket_name: str,
+    folder: str,
+    user_id: int,
+    filename: str,
+    chunks: AsyncIterable[bytes],
+    part_size: int = S3_PART_SIZE,
+    concurrency: int = S3_UPLOAD_CONCURRENCY,
+) -> str:
+    """Uploads content produced by an async iterable without keeping it in memory.
+    Content is split into parts of `part_size` that are uploaded `concurrency` at
+    a time; content smaller than one part is uploaded with a single request."""
+    path = f"{folder}/{user_id}/{filename}"
+
+    s3_client = await get_shared_client()
+    upload_id: str | None = None
+    semaphore = asyncio.Semaphore(concurrency)
+    tasks: list[asyncio.Task] = []
+
+    async def upload_part(number: int, body: bytes) -> dict[str, Any]:
+        try:
+            response = await s3_client.upload_part(
+                Bucket=bucket_name,
+                Key=path,
+                UploadId=upload_id,
+                PartNumber=number,
+                Body=body,
+            )
+            return {"PartNumber": number, "ETag": response["ETag"]}
+        finally:
+            semaphore.release()
+
+    async def submit(body: bytes) -> None:
+        nonlocal upload_id
+
+        if upload_id is None:
+            response = await s3_client.create_multipart_upload(
+                Bucket=bucket_name, Key=path
+            )
+            upload_id = response["UploadId"]
+
+        # Limits both parallelism and the number of parts held in memory
+        await semaphore.acquire()
+        tasks.append(asyncio.ensure_future(upload_part(len(tasks) + 1, body)))
+
+    buffer = bytearray()
+
+    try:
+        async for chunk in chunks:
+            buffer += chunk
+
+            while len(buffer) >= part_size:
+                await submit(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+
+        if upload_id is None:
+            await s3_client.put_object(Bucket=bucket_name, Key=path, Body=bytes(buffer))
+        else:
+            if buffer:
+                await submit(bytes(buffer))
+
+            parts = await asyncio.gather(*tasks)
+            await s3_client.complete_multipart_upload(
+                Bucket=bucket_name,
+                Key=path,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if upload_id is not None:
+            await s3_client.abort_multipart_upload(
+                Bucket=bucket_name, Key=path, UploadId=upload_id
+            )
+        raise
 
-        await bucket.upload_fileobj(io.BytesIO(content), path)
+    remember_upload(bucket_name, folder, user_id, filename)
 
     return path
 
 
-__all__ = ["list_files", "get_url", "upload_file", "upload_bytes"]
+__all__ = [
+    "list_files",
+    "get_url",
+    "get_urls",
+    "upload_file",
+    "upload_bytes",
+    "upload_stream",
+]
@@ -1,3 +1,5 @@
+from sqlalchemy import Connection, Enum, inspect, text
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from starlette.datastructures import URL
 
@@ -11,10 +13,91 @@ def get_engine(url: str | URL) -> AsyncEngine:
     return create_async_engine(url)
 
 
+def add_enum_values(conn: Connection) -> None:
+    """Adds values missing from existing PostgreSQL enum types, as `create_all`
+    does not alter types it has created before."""
+    if conn.dialect.name != "postgresql":
+        return
+
+    enums: dict[str, Enum] = {}
+    for table in Base.metadata.tables.values():
+        for column in table.columns:
+            if isinstance(column.type, Enum) and column.type.name:
+                enums[column.type.name] = column.type
+
+    for name, enum in enums.items():
+        existing = set(
+            conn.scalars(
+                text(
+                    "SELECT enumlabel FROM pg_enum "
+                    "JOIN pg_type ON pg_type.oid = pg_enum.enumtypid "
+                    "WHERE pg_type.typname = :name"
+                ),
+                {"name": name},
+            )
+        )
+
+        for value in enum.enums:
+            if value not in existing:
+                quoted = conn.dialect.identifier_preparer.quote(name)
+                conn.execute(
+                    text(f"ALTER TYPE {quoted} ADD VALUE IF NOT EXISTS '{value}'")
+                )
+
+
+def add_missing_columns(conn: Connection) -> None:
+    """Adds nullable columns missing from existing tables, as `create_all` does not
+    alter tables it has created before. Other changes still need manual migration."""
+    inspector = inspect(conn)
+
+    for table in Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+
+            definition = CreateColumn(column).compile(dialect=conn.dialect)
+            conn.execute(
+                text(
+                    f"ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} "
+                    f"ADD COLUMN IF NOT EXISTS {definition}"
+                )
+            )
+
+
+def check_partitioned_tables(conn: Connection) -> None:
+    """Refuses to start if a table declared as partitioned exists as a plain one,
+    e.g. created before partitioning, as `create_all` would keep it as is."""
+    if conn.dialect.name != "postgresql":
+        return
+
+    for table in Base.metadata.sorted_tables:
+        if not table.dialect_options["postgresql"].get("partition_by"):
+            continue
+
+        relkind = conn.scalar(
+            text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:name)"),
+            {"name": conn.dialect.identifier_preparer.format_table(table)},
+        )
+
+        if relkind is not None and relkind != "p":
+            raise RuntimeError(
+                f"Table {table.name} exists, but is not partitioned. Rename it "
+                f"with its indexes and sequences, so that it is created again"
+            )
+
+
 async def create_tables(engine: AsyncEngine) -> None:
     """Creates all tables that are in the context at the moment."""
     async with engine.begin() as conn:
+        await conn.run_sync(check_partitioned_tables)
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(add_enum_values)
+        await conn.run_sync(add_missing_columns)
 
 
 __all__ = ["get_engine", "create_tables"]
@@ -9,7 +9,10 @@ from starlette.staticfiles import StaticFiles
 from starlette_wtf import CSRFProtectMiddleware
 
 from quirck.auth.router import sso_router
-from quirck.core import config
+from quirck.box.client import close_docker
+from quirck.box.router import box_router
+from quirck.box.vpn import close_executor
+from quirck.core import config, s3
 from quirck.core.module import app
 from quirck.db.middleware import DatabaseMiddleware
 from quirck.web.handlers import exception_handler
@@ -21,6 +24,9 @@ def build_app() -> Starlette:
         yield  # Run app
         if hasattr(app, "shutdown"):
             await app.shutdown()
+        await close_docker()
+        close_executor()
+        await s3.close_shared_client()
 
     return Starlette(
         middleware=[
@@ -35,6 +41,7 @@ def build_app() -> Starlette:
         ],
         routes=[
             Mount("/auth", sso_router, name="auth"),
+            Mount("/box", box_router, name="box"),
             Mount("/static", app=StaticFiles(directory=app.static_path), name="static"),
             app.mount,
         ],
@@ -25,6 +25,7 @@ def exception_handler(request: Request, exc: Exception) -> Response:
             "error": exc.detail,
         },
         status_code=exc.status_code,
+        headers=getattr(exc, "headers", None),
     )
 
 
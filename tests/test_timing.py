@@ -0,0 +1,65 @@
+"""
+Timing of launches and stops against a real database. Set `TEST_DATABASE_URL` to
+an empty PostgreSQL database to run them:
+
+    TEST_DATABASE_URL=postgresql+asyncpg://... python -m unittest discover tests
+"""
+
+import os
+import unittest
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL is not set")
+class PhaseHistogramTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        from quirck.auth.model import User
+        from quirck.box import model  # noqa: F401, registers tables
+        from quirck.db.base import Base
+        from quirck.db.engine import create_tables, get_engine
+
+        self.engine = get_engine(TEST_DATABASE_URL)
+        await create_tables(self.engine)
+        self.factory = async_sessionmaker(self.engine, expire_on_commit=False)
+
+        async with self.factory() as session:
+            self.user = User(id=1, name="test")
+            await session.merge(self.user)
+            await session.commit()
+
+        self.addAsyncCleanup(self.drop_tables, Base)
+
+    async def drop_tables(self, base) -> None:
+        async with self.engine.begin() as conn:
+            await conn.run_sync(base.metadata.drop_all)
+        await self.engine.dispose()
+
+    async def test_stop_without_images(self) -> None:
+        from quirck.box.timing import Timing, measure, phase_histogram, store
+        from quirck.core.metrics import render
+
+        timing = Timing("stop", "lab")
+        with timing.activate(), measure("cleaning"):
+            pass
+
+        async with self.factory() as session:
+            await store(session, timing.finish(self.user.id, None, "stopped"))
+            text = render([await phase_histogram(session)])
+
+        self.assertIn(
+            'quirck_box_phase_seconds_count{operation="stop",phase="cleaning",'
+            'chapter="lab",image=""} 1',
+            text,
+        )
+        self.assertIn(
+            'quirck_box_phase_seconds_count{operation="stop",phase="total",'
+            'chapter="lab",image=""} 1',
+            text,
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()